@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""Microbenchmarks for the hot paths of the bTCP implementation.
+
+Run e.g. `python3 benchmark.py checksum` and compare the numbers before and
+after a change. Every benchmark prints one line per variant it measures.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+import timeit
+
+from btcp import checksum, congestion
+from btcp.btcp_socket import BTCPSocket
+from btcp.client_socket import BTCPClientSocket
+from btcp.constants import *
+from btcp.lossy_layer import LossyLayer
+from btcp.ringbuffer import RingBuffer
+from btcp.server_socket import BTCPServerSocket
+
+
+def _report(name, count, seconds):
+    print("{:<32} {:>12.0f} segments/s".format(name, count / seconds))
+
+
+def bench_checksum(args):
+    """Segments per second checksummed at SEGMENT_SIZE, for the reference
+    16-bit-at-a-time implementation and the checksum engine."""
+    segments = [os.urandom(SEGMENT_SIZE) for _ in range(64)]
+    for name, func in (("in_cksum_reference", checksum.in_cksum_reference),
+                       ("in_cksum", checksum.in_cksum)):
+        seconds = min(timeit.repeat(lambda: [func(s) for s in segments],
+                                    number=args.number, repeat=args.repeat))
+        _report(name, len(segments) * args.number, seconds)
+
+
+class _Sink:
+    """Stands in for a bTCP socket and counts what the lossy layer hands it.
+
+    Verifies every segment's checksum, as a real socket would, so the network
+    thread has per-segment work to do while datagrams queue up.
+    """
+    def __init__(self):
+        self.segments = 0
+        self.batches = 0
+        self.first = None
+        self.last = None
+        self.sending = True
+        self.idle = threading.Event()
+
+    def lossy_layer_segments_received(self, segments):
+        self.last = time.perf_counter()
+        if self.first is None:
+            self.first = self.last
+        self.batches += 1
+        self.segments += len(segments)
+        for segment in segments:
+            checksum.in_cksum(segment)
+
+    def lossy_layer_tick(self):
+        if not self.sending:
+            self.idle.set()
+
+
+def _flood(args, offload=False, **lossy_layer_args):
+    """Send args.count segments between two LossyLayers, in window-sized
+    bursts of args.burst, and return the receiving sink once the network went
+    quiet."""
+    sink = _Sink()
+    receiver = LossyLayer(sink, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT,
+                          offload=offload, **lossy_layer_args)
+    sender = LossyLayer(_Sink(), CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT,
+                        offload=offload)
+    burst = [BTCPSocket.build_segment_parts(seqnum, 0,
+                                            payload=os.urandom(PAYLOAD_SIZE))
+             for seqnum in range(args.burst)]
+    for _ in range(args.count // args.burst):
+        sender.send_segments(burst)
+        time.sleep(0.001)
+    sink.sending = False
+    sink.idle.wait()
+    sender.destroy()
+    receiver.destroy()
+    return sink
+
+
+def _report_flood(name, args, sink):
+    mib = sink.segments * PAYLOAD_SIZE / 2**20
+    _report(name, sink.segments, (sink.last - sink.first) or 1e-9)
+    print("{:<32} {:>12.1f} wakeups/MiB, {} of {} segments arrived".format(
+        "", sink.batches / mib, sink.segments,
+        args.count // args.burst * args.burst))
+
+
+def bench_recv(args):
+    """Receive rate and network thread wakeups per MiB delivered, with one
+    datagram per wakeup versus draining up to RECV_BATCH per wakeup."""
+    for name, batch_limit in (("recv batch 1", 1),
+                              ("recv batch {}".format(RECV_BATCH), RECV_BATCH)):
+        _report_flood(name, args, _flood(args, batch_limit=batch_limit))
+
+
+def bench_offload(args):
+    """Loopback transfer rate and wakeups per MiB of the plain send/receive
+    path versus UDP GSO/GRO offload."""
+    for name, offload in (("plain", False), ("offload", True)):
+        _report_flood(name, args, _flood(args, offload=offload))
+
+
+def bench_send(args):
+    """Segments per second built and sent by LossyLayer.send_segment, with
+    the header concatenated to the zero-padded payload versus scatter/gather
+    sending of the unpadded payload."""
+    sink = _Sink()
+    layer = LossyLayer(sink, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+    chunk = bytearray(os.urandom(PAYLOAD_SIZE - 1))
+    padding = bytes(PAYLOAD_SIZE - len(chunk))
+
+    def concatenated():
+        header = BTCPSocket.build_segment_header(1, 2, length=len(chunk))
+        cksum = BTCPSocket.in_cksum(header + chunk + padding)
+        header = BTCPSocket.build_segment_header(1, 2, length=len(chunk),
+                                                 checksum=cksum)
+        layer.send_segment(header + chunk + padding)
+
+    def scatter_gather():
+        layer.send_segment(BTCPSocket.build_segment_parts(1, 2, payload=chunk))
+
+    for name, func in (("send concatenated", concatenated),
+                       ("send scatter/gather", scatter_gather)):
+        seconds = min(timeit.repeat(func, number=args.count,
+                                    repeat=args.repeat))
+        _report(name, args.count, seconds)
+    layer.destroy()
+
+
+def bench_buffer(args):
+    """Segments per second passed through a send buffer: written as one
+    burst of args.burst segments' worth and taken out one payload at a time,
+    with a queue.Queue of payload-sized chunks versus the RingBuffer."""
+    data = os.urandom(args.burst * PAYLOAD_SIZE)
+    chunks = queue.Queue()
+    ring = RingBuffer(len(data))
+
+    def chunk_queue():
+        for start in range(0, len(data), PAYLOAD_SIZE):
+            chunks.put_nowait(data[start:start + PAYLOAD_SIZE])
+        try:
+            while True:
+                chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+    def ring_buffer():
+        ring.write(data)
+        for position in range(ring.head, ring.tail, PAYLOAD_SIZE):
+            ring.peek(position, PAYLOAD_SIZE)
+        ring.consume(len(data))
+
+    for name, func in (("buffer queue", chunk_queue),
+                       ("buffer ring", ring_buffer)):
+        seconds = min(timeit.repeat(func, number=args.number,
+                                    repeat=args.repeat))
+        _report(name, args.burst * args.number, seconds)
+
+
+def _transfer(args, congestion_control=CONGESTION_CONTROL, window=None):
+    """Send args.count segments worth of data from a client to a server
+    socket over loopback, with window (default args.window) on both ends;
+    return the seconds it took and the client's congestion control instance,
+    with its trace recorded."""
+    window = window or args.window
+    data = os.urandom(args.count * PAYLOAD_SIZE)
+    server = BTCPServerSocket(window, args.timeout)
+
+    def serve():
+        server.accept()
+        while server.recv():
+            pass
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client = BTCPClientSocket(window, args.timeout, congestion_control)
+    client.congestion.trace = []
+    start = time.perf_counter()
+    client.connect()
+    sent = 0
+    while sent < len(data):
+        sent += client.send(data[sent:])
+        time.sleep(0.001)
+    client.shutdown()
+    seconds = time.perf_counter() - start
+    client.close()
+    thread.join()
+    server.close()
+    return seconds, client.congestion
+
+
+def bench_cwnd(args):
+    """Transfer rate and congestion window evolution of every congestion
+    control algorithm. With --trace, every change of cwnd is written to that
+    file as CSV: algorithm, seconds since the first change, cwnd, ssthresh."""
+    rows = []
+    for name in congestion.ALGORITHMS:
+        seconds, cc = _transfer(args, name)
+        _report(name, args.count, seconds)
+        cwnds = [cwnd for _, cwnd, _ in cc.trace] or [cc.cwnd]
+        print("{:<32} {:>12.1f} mean cwnd, {:.1f} max, {} changes".format(
+            "", sum(cwnds) / len(cwnds), max(cwnds), len(cc.trace)))
+        start = cc.trace[0][0] if cc.trace else 0
+        rows.extend((name, now - start, cwnd, ssthresh)
+                    for now, cwnd, ssthresh in cc.trace)
+    if args.trace:
+        with open(args.trace, 'w') as outfile:
+            outfile.write("algorithm,seconds,cwnd,ssthresh\n")
+            for row in rows:
+                outfile.write("{},{:.6f},{:.3f},{}\n".format(*row))
+
+
+def bench_window(args):
+    """Transfer rate for windows up to and beyond the 255 segments the
+    header's window field holds unscaled. Only meaningful with a round trip
+    time long enough for the window to be the limit, so run it under the
+    testframework's NETEM_DELAY profile, e.g. after
+    `tc qdisc add dev lo root netem delay 100ms 20ms`."""
+    for window in (64, 128, 255, 512, 1024, 2048):
+        seconds, _ = _transfer(args, window=window)
+        _report("window {}".format(window), args.count, seconds)
+
+
+BENCHMARKS = {
+    "checksum": bench_checksum,
+    "recv": bench_recv,
+    "send": bench_send,
+    "buffer": bench_buffer,
+    "offload": bench_offload,
+    "cwnd": bench_cwnd,
+    "window": bench_window,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bTCP microbenchmarks")
+    parser.add_argument("benchmark",
+                        choices=sorted(BENCHMARKS),
+                        help="Benchmark to run")
+    parser.add_argument("-n", "--number",
+                        help="Iterations per timing run",
+                        type=int, default=200)
+    parser.add_argument("-r", "--repeat",
+                        help="Timing runs; the fastest one is reported",
+                        type=int, default=5)
+    parser.add_argument("-c", "--count",
+                        help="Segments to send in network benchmarks",
+                        type=int, default=20000)
+    parser.add_argument("-b", "--burst",
+                        help="Segments per burst in network benchmarks",
+                        type=int, default=32)
+    parser.add_argument("-w", "--window",
+                        help="bTCP window size in socket benchmarks",
+                        type=int, default=100)
+    parser.add_argument("-t", "--timeout",
+                        help="Initial bTCP retransmission timeout in "
+                             "milliseconds in socket benchmarks",
+                        type=int, default=100)
+    parser.add_argument("--trace",
+                        help="File to write the cwnd benchmark's trace to")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -1,7 +1,10 @@
-import struct
 import logging
+import random
 from enum import IntEnum
 
+from btcp import checksum, codec
+from btcp.constants import *
+
 
 logger = logging.getLogger(__name__)
 
@@ -50,15 +53,230 @@ class BTCPSocket:
     """
     def __init__(self, window, timeout):
         logger.debug("__init__ called")
+        if not 0 < window <= MAX_WINDOW:
+            raise ValueError("Window must be between 1 and {} segments"
+                             .format(MAX_WINDOW))
         self._window = window
         self._timeout = timeout
+        # Round trip time estimation (RFC 6298), in milliseconds. The timeout
+        # given to the constructor is only the initial RTO.
+        self._srtt = None
+        self._rttvar = None
+        self._rto = min(max(timeout, MIN_RTO), MAX_RTO)
         self._state = BTCPStates.CLOSED
+        # How many segments we may pack into one datagram towards the peer.
+        # Stays 1 unless negotiated in the handshake; see _negotiate.
+        self._segments_per_datagram = 1
+        # How many SACK blocks we send to, or accept from, the peer.
+        # Stays 0 (no SACK) unless negotiated in the handshake.
+        self._sack_blocks = 0
+        # Whether ACKs carry receive timestamps. Only if negotiated, too.
+        self._timestamps = False
+        # Shift counts of the window field in segments we send and receive.
+        # Stay 0 unless both ends offer window scaling in the handshake.
+        self._window_shift = 0
+        self._peer_window_shift = 0
+        # Our initial sequence number, and how many bits of sequence numbers
+        # go on the wire: the 16 of the header fields, or 32 once extended
+        # sequence numbers were negotiated. Their extension then takes up
+        # part of every segment's payload.
+        self._isn = random.randrange(0x100000000)
+        self._seq_bits = 16
+        self._max_payload = PAYLOAD_SIZE
         logger.debug("Socket initialized with window %i and timeout %i",
                      self._window, self._timeout)
 
 
+    @property
+    def rto(self):
+        """Current retransmission timeout in milliseconds."""
+        return self._rto
+
+
+    @property
+    def srtt(self):
+        """Smoothed round trip time in milliseconds, or None before the first
+        measurement."""
+        return self._srtt
+
+
+    def _rtt_sample(self, rtt):
+        """Update SRTT, RTTVAR and the RTO with a round trip time measured in
+        milliseconds (Jacobson/Karels).
+
+        Per Karn's rule, only pass samples of segments that were not
+        retransmitted: an ACK for a retransmitted segment could belong to any
+        of its transmissions.
+        """
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        self._rto = min(max(self._srtt + 4 * self._rttvar, MIN_RTO), MAX_RTO)
+        logger.debug("RTT sample %.3fms, SRTT %.3fms, RTO %.3fms",
+                     rtt, self._srtt, self._rto)
+
+
+    def _rto_backoff(self):
+        """Double the RTO after the retransmission timer expired."""
+        self._rto = min(self._rto * 2, MAX_RTO)
+
+
+    def _rto_ns(self):
+        """The current RTO in nanoseconds, for time.monotonic_ns deadlines."""
+        return int(self._rto * 1_000_000)
+
+
+    @staticmethod
+    def _datagram_size():
+        """Largest datagram this end can receive, for the LossyLayer."""
+        return min(SEGMENTS_PER_DATAGRAM * SEGMENT_SIZE, MAX_DATAGRAM_SIZE)
+
+
+    def _window_scale(self):
+        """The smallest shift count that fits our window in the 8-bit
+        window field."""
+        shift = 0
+        while self._window >> shift > 0xFF:
+            shift += 1
+        return shift
+
+
+    def _advertised_window(self):
+        """Window value for our own headers: the window, scaled down by the
+        negotiated shift count to fit the 8-bit field.
+        """
+        return min(self._window >> self._window_shift, 0xFF)
+
+
+    def _syn_options(self, offered=None):
+        """Return the options payload for our SYN, or for our SYN|ACK in
+        response to a SYN that carried options offered.
+
+        A SYN offers everything we support; a SYN|ACK only confirms what the
+        peer offered as well, so a plain peer never sees an option.
+        """
+        options = {}
+        if (SEGMENTS_PER_DATAGRAM > 1
+                and (offered is None
+                     or codec.OPT_SEGMENTS_PER_DATAGRAM in offered)):
+            options[codec.OPT_SEGMENTS_PER_DATAGRAM] = bytes(
+                [self._datagram_size() // SEGMENT_SIZE])
+        if (SACK_BLOCKS > 0
+                and (offered is None
+                     or codec.OPT_SACK_PERMITTED in offered)):
+            options[codec.OPT_SACK_PERMITTED] = bytes([SACK_BLOCKS])
+        if (TIMESTAMPS
+                and (offered is None or codec.OPT_TIMESTAMPS in offered)):
+            options[codec.OPT_TIMESTAMPS] = b''
+        if offered is None or codec.OPT_WINDOW_SCALE in offered:
+            options[codec.OPT_WINDOW_SCALE] = bytes([self._window_scale()])
+        if (EXTENDED_SEQ
+                and (offered is None or codec.OPT_EXTENDED_SEQ in offered)):
+            options[codec.OPT_EXTENDED_SEQ] = (self._isn >> 16).to_bytes(
+                2, 'big')
+        return codec.pack_options(options)
+
+
+    def _negotiate(self, payload):
+        """Apply the options the peer sent in the payload of its SYN or
+        SYN|ACK, and return them as a dict for _syn_options.
+        """
+        options = codec.unpack_options(payload)
+        value = options.get(codec.OPT_SEGMENTS_PER_DATAGRAM)
+        if value and SEGMENTS_PER_DATAGRAM > 1:
+            self._segments_per_datagram = max(1, min(
+                value[0], MAX_DATAGRAM_SIZE // SEGMENT_SIZE))
+            logger.info("Peer accepts %i segments per datagram",
+                        self._segments_per_datagram)
+        value = options.get(codec.OPT_SACK_PERMITTED)
+        if value and SACK_BLOCKS > 0:
+            self._sack_blocks = min(value[0], SACK_BLOCKS)
+            logger.info("Peer accepts %i SACK blocks", self._sack_blocks)
+        if codec.OPT_TIMESTAMPS in options and TIMESTAMPS:
+            self._timestamps = True
+            logger.info("Peer accepts receive timestamps")
+        value = options.get(codec.OPT_WINDOW_SCALE)
+        if value:
+            self._window_shift = self._window_scale()
+            self._peer_window_shift = min(value[0], MAX_WINDOW_SCALE)
+            logger.info("Window scaling: ours %i, peer's %i",
+                        self._window_shift, self._peer_window_shift)
+        value = options.get(codec.OPT_EXTENDED_SEQ)
+        if value is not None and len(value) == 2 and EXTENDED_SEQ:
+            self._seq_bits = 32
+            self._max_payload = PAYLOAD_SIZE - codec.EXTENSION.size
+            logger.info("Peer accepts extended sequence numbers")
+        return options
+
+
+    def _peer_isn(self, seqnum, options):
+        """The peer's initial sequence number: seqnum from the header of its
+        SYN, widened by the upper bits in its options if extended sequence
+        numbers were negotiated."""
+        if self._seq_bits == 16:
+            return seqnum
+        high = int.from_bytes(options[codec.OPT_EXTENDED_SEQ], 'big')
+        return high << 16 | seqnum
+
+
+    def _extension(self, seqnum, acknum):
+        """The bytes leading the payload of a segment (other than a SYN)
+        with the unwrapped seqnum and acknum: their upper 16 bits with
+        extended sequence numbers, else nothing."""
+        if self._seq_bits == 16:
+            return b''
+        return codec.EXTENSION.pack(seqnum >> 16 & 0xFFFF,
+                                    acknum >> 16 & 0xFFFF)
+
+
+    def _refresh_extension(self, segment, seqnum, acknum):
+        """Update the extension of a stored segment (a bytearray) built with
+        one, in place, like refresh_segment_header."""
+        if self._seq_bits == 32:
+            codec.refresh_field(segment, HEADER_SIZE, codec.EXTENSION,
+                                seqnum >> 16 & 0xFFFF, acknum >> 16 & 0xFFFF)
+
+
+    def _unpack_segment(self, segment):
+        """Decode a verified segment into its header values and a view of
+        its payload. With extended sequence numbers, seqnum and acknum of a
+        segment other than a SYN are widened to 32 bits from its extension,
+        which is left out of payload and length.
+
+        Return None for a segment that lacks the extension it should have.
+        """
+        header = self.unpack_segment_header(segment)
+        seqnum, acknum, syn_set, ack_set, fin_set, window, length, cksum = header
+        payload = memoryview(segment)[HEADER_SIZE:]
+        if self._seq_bits == 16 or syn_set:
+            return header, payload
+        if len(payload) < codec.EXTENSION.size:
+            return None
+        high_seqnum, high_acknum = codec.EXTENSION.unpack_from(payload)
+        return ((high_seqnum << 16 | seqnum, high_acknum << 16 | acknum,
+                 syn_set, ack_set, fin_set, window,
+                 length - codec.EXTENSION.size, cksum),
+                payload[codec.EXTENSION.size:])
+
+
+    def lossy_layer_segments_received(self, segments):
+        """Called by the lossy layer with all segments drained from the
+        network in one wakeup of the network thread.
+
+        By default simply handles them one by one; subclasses can override
+        this to do per-batch work once per batch rather than per segment.
+        """
+        logger.debug("lossy_layer_segments_received called with %i segments",
+                     len(segments))
+        for segment in segments:
+            self.lossy_layer_segment_received(segment)
+
+
     @staticmethod
-    def in_cksum(segment):
+    def in_cksum(segment, *parts):
         """Compute the internet checksum of the segment given as argument.
         Consult lecture 3 for details.
 
@@ -67,21 +285,20 @@ class BTCPSocket:
         Remember that, when computing the checksum value before *sending* the
         segment, the checksum field in the header should be set to 0x0000, and
         then the resulting checksum should be put in its place.
+
+        A segment that is kept as separate buffers (e.g. header and payload)
+        can be checksummed without joining them by passing the other buffers
+        as extra arguments.
         """
 
         logger.debug("in_cksum() called")
 
         if not segment:
             raise ValueError("Asked to checksum an empty segment.")
-        
-        acc = sum(x for (x,) in struct.iter_unpack(R'!H', segment))
-        while acc > 0xFFFF:
-            carry = acc >> 16
-            acc &= 0xFFFF
-            acc += carry
-        return acc if acc == 0xFFFF else (~acc & 0xFFFF)
 
-        #raise NotImplementedError("No implementation of in_cksum present. Read the comments & code of btcp_socket.py.")
+        # The whole segment is folded at once by the checksum engine rather
+        # than 16 bits at a time; see btcp/checksum.py.
+        return checksum.in_cksum(segment, *parts)
 
 
     @staticmethod
@@ -97,11 +314,50 @@ class BTCPSocket:
         return BTCPSocket.in_cksum(segment) == 0xFFFF
 
 
+    @staticmethod
+    def verify_segment(segment):
+        """Verify that segment is exactly as long as its header says, and that
+        its checksum is correct.
+
+        Segments are not padded to SEGMENT_SIZE, so the length check is what
+        catches truncated segments or a corrupted length field before the
+        header values are trusted.
+        """
+        logger.debug("verify_segment() called")
+        return (codec.valid_length(segment)
+                and BTCPSocket.verify_checksum(segment))
+
+
+    @staticmethod
+    def update_checksum(cksum, old_header, new_header):
+        """Return the checksum of a segment whose header changed from
+        old_header to new_header, given its previous checksum cksum.
+
+        Both headers must have their checksum field set to 0x0000, as when
+        computing the checksum before sending. Only the header is folded, so
+        refreshing e.g. the ack number or window of a stored segment costs the
+        same regardless of its payload size.
+        """
+        logger.debug("update_checksum() called")
+        return checksum.update(cksum, old_header, new_header)
+
+
+    @staticmethod
+    def refresh_segment_header(header, acknum, window):
+        """Set acknum and window of a stored segment's header (a bytearray)
+        before resending it, updating its checksum with update_checksum's
+        incremental method rather than recomputing it over the payload.
+        """
+        logger.debug("refresh_segment_header() called")
+        codec.refresh_header(header, acknum, window)
+
+
     @staticmethod
     def build_segment_header(seqnum, acknum,
                              syn_set=False, ack_set=False, fin_set=False,
                              window=0x01, length=0, checksum=0):
-        """Pack the method arguments into a valid bTCP header using struct.pack
+        """Pack the method arguments into a valid bTCP header using the
+        precompiled header codec in btcp/codec.py.
 
         This method is given because historically students had a lot of trouble
         figuring out how to pack and unpack values into / out of the header.
@@ -122,10 +378,8 @@ class BTCPSocket:
         a checksum of 0 when creating the header for checksum computation.
         """
         logger.debug("build_segment_header() called")
-        flag_byte = syn_set << 2 | ack_set << 1 | fin_set
-        logger.debug("build_segment_header() done")
-        return struct.pack("!HHBBHH",
-                           seqnum, acknum, flag_byte, window, length, checksum)
+        return codec.pack_header(seqnum, acknum, syn_set, ack_set, fin_set,
+                                 window, length, checksum)
 
 
     @staticmethod
@@ -135,15 +389,41 @@ class BTCPSocket:
         Remember that Python supports multiple return values through automatic
         tupling, so it's easy to simply return all of them in one go rather
         than make a separate method for every individual field.
+
+        header may be a whole segment, or a memoryview into a receive buffer;
+        only the first HEADER_SIZE bytes are read and nothing is sliced.
         """
         logger.debug("unpack_segment_header() called")
+        return codec.unpack_header(header)
 
-        (seq_num, ack_num, flags, window, btcp_length, checksum) = struct.unpack_from("!HHBBHH", header) 
-        
-        fin_set = flags % 2
-        ack_set = (flags >> 1) % 2
-        syn_set = (flags >> 2) % 2
-        return seq_num, ack_num, syn_set, ack_set, fin_set, window, btcp_length, checksum
-    
-        #raise NotImplementedError("No implementation of unpack_segment_header present. Read the comments & code of btcp_socket.py. You should really implement the packing / unpacking of the header into field values before doing anything else!")
-        logger.debug("unpack_segment_header() done")
+
+    @staticmethod
+    def build_segment(seqnum, acknum,
+                      syn_set=False, ack_set=False, fin_set=False,
+                      window=0x01, payload=b''):
+        """Build a complete, checksummed segment carrying payload.
+
+        Header and payload are packed into a single preallocated bytearray,
+        rather than packing the header and concatenating the payload to it.
+        """
+        logger.debug("build_segment() called")
+        return codec.build_segment(seqnum, acknum, syn_set, ack_set, fin_set,
+                                   window, payload)
+
+
+    @staticmethod
+    def build_segment_parts(seqnum, acknum,
+                            syn_set=False, ack_set=False, fin_set=False,
+                            window=0x01, payload=b'', prefix=b''):
+        """Build a complete, checksummed segment carrying payload as a tuple
+        of buffers for scatter/gather sending by LossyLayer.send_segment.
+
+        The payload buffer is used as-is, so resending a stored payload with
+        a fresh header never copies it; a prefix to it (e.g. an extension)
+        is stored in the header buffer. Segments are never padded: only
+        HEADER_SIZE + len(prefix) + len(payload) bytes go on the wire.
+        """
+        logger.debug("build_segment_parts() called")
+        return codec.build_segment_parts(seqnum, acknum,
+                                         syn_set, ack_set, fin_set,
+                                         window, payload, prefix)
@@ -1,14 +1,41 @@
-from btcp.btcp_socket import BTCPSocket, BTCPStates
+from btcp import codec, congestion, serial
+from btcp.btcp_socket import BTCPSocket, BTCPStates, BTCPSignals
 from btcp.lossy_layer import LossyLayer
+from btcp.ringbuffer import RingBuffer
 from btcp.constants import *
 
-import queue
+import time
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+class _SentSegment:
+    """A data segment that was sent but not yet acknowledged, kept in the
+    sender's ring for retransmission.
+
+    header is the complete header as last sent (a bytearray, so it can be
+    refreshed in place), payload a memoryview into the send buffer (or a
+    copy, if it wrapped around the buffer's end), which keeps its bytes
+    until the segment is acknowledged.
+    sacked is set once the server selectively acknowledged the segment, lost
+    while it is considered lost, after a retransmission timeout or by the
+    SACK scoreboard, but has not been retransmitted yet.
+    """
+    __slots__ = ("seqnum", "header", "payload", "sent", "retransmitted",
+                 "sacked", "lost")
+
+    def __init__(self, seqnum, header, payload, sent):
+        self.seqnum = seqnum
+        self.header = header
+        self.payload = payload
+        self.sent = sent
+        self.retransmitted = False
+        self.sacked = False
+        self.lost = False
+
+
 class BTCPClientSocket(BTCPSocket):
     """bTCP client socket
     A client application makes use of the services provided by bTCP by calling
@@ -34,21 +61,107 @@ class BTCPClientSocket(BTCPSocket):
     """
 
 
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout,
+                 congestion_control=CONGESTION_CONTROL,
+                 max_send_buffer=MAX_SEND_BUFFER):
         """Constructor for the bTCP client socket. Allocates local resources
         and starts an instance of the Lossy Layer.
 
+        congestion_control names one of the algorithms in
+        btcp.congestion.ALGORITHMS. max_send_buffer (in bytes) is the
+        ceiling of send buffer autosizing, see MAX_SEND_BUFFER.
+
         You can extend this method if you need additional attributes to be
         initialized, but do *not* call connect from here.
         """
         logger.debug("__init__ called")
         super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        self._congestion = congestion.create(congestion_control)
+        self._congestion.max_window = self._window
 
         # The data buffer used by send() to send data from the application
-        # thread into the network thread. Bounded in size.
-        self._sendbuf = queue.Queue(maxsize=1000)
-        logger.info("Socket initialized with sendbuf size 1000")
+        # thread into the network thread. It holds every byte not yet
+        # acknowledged: the network thread builds segments straight out of
+        # it, from _send_next on, and only takes their bytes out once they
+        # are acknowledged, so they are still there to be retransmitted.
+        # Its capacity only grows, from the network thread.
+        self._sendbuf = RingBuffer(min(SEND_BUFFER, max_send_buffer))
+        self._max_sndbuf_size = max_send_buffer
+        self._send_next = 0         # stream position of the next byte to send
+
+        # Selective Repeat sender state, only used from the network thread
+        # once connected. Sequence numbers are kept unwrapped here, reduced
+        # to _seq_bits bits on the wire and unwrapped again with the serial
+        # module on arrival. The ring holds every sent but
+        # unacknowledged data segment at index seqnum % window; only the
+        # oldest one is retransmitted when the retransmission timer expires.
+        self._ring = [None] * self._window
+        self._send_base = 0         # oldest unacknowledged seqnum
+        self._next_seq = 0          # seqnum of the next new data segment
+        self._peer_window = 1       # window last advertised by the server
+        self._acknum = 0            # next seqnum expected from the server
+        self._rto_deadline = None   # monotonic_ns; None if nothing in flight
+        self._retries = 0
+        # Persist timer: while the server advertises a zero window and we
+        # have data for it, it is probed for its window at this deadline
+        # (monotonic_ns), backing off exponentially with every probe.
+        self._persist_deadline = None
+        self._probes = 0
+        # SACK scoreboard: the ring entries' sacked flags, and the seqnum
+        # _marked below which holes were already looked at. A hole with at
+        # least _dupthresh sacked segments above it, or the oldest segment
+        # after _dupthresh duplicate ACKs, is considered lost. _dupthresh
+        # grows whenever reordering is detected, e.g. when the server
+        # reports (with a D-SACK block) a duplicate of a segment we
+        # retransmitted exactly once, fast, and decays by one for every
+        # window of segments acknowledged since, _ordered. _retransmitted
+        # maps each recently retransmitted seqnum to whether that is the
+        # case.
+        self._marked = 0
+        self._sacked = 0            # number of entries with sacked set
+        self._lost = 0              # number of entries with lost set
+        self._dupacks = 0
+        self._dupthresh = DUPACK_THRESHOLD
+        self._ordered = 0
+        self._retransmitted = {}
+        # Congestion control state besides the algorithm itself: losses
+        # found before _send_base passes _recover belong to the same
+        # congestion event (which, unless it was a timeout, puts us in fast
+        # recovery until then), and paced segments go out no sooner than
+        # _pacing_next (monotonic_ns). _pacing_deadline is _pacing_next while
+        # pacing holds back a segment we could otherwise send, else None.
+        # Without SACK, _inflation is added to cwnd in fast recovery: each
+        # duplicate ACK means a segment left the network (RFC 6582).
+        self._recover = 0
+        self._fast_recovery = False
+        self._inflation = 0
+        self._pacing_next = 0
+        self._pacing_deadline = None
+        self._delivered = 0         # newly delivered by the current ACK
+        # Sent time (monotonic_ns) of the newest segment the current ACK
+        # delivered, if it yields delay samples; and the first one-way delay
+        # measured, which later ones are taken relative to, as the two ends'
+        # clocks are not synchronized.
+        self._delivered_sent = None
+        self._delay_origin = None
+
+        # The SYN or FIN that is retransmitted until answered, and the signal
+        # from the application thread that it wants to shut down.
+        self._control = None
+        self._control_sent = None
+        self._control_deadline = None
+        self._signal = None
+        # Whether we are handling a batch of segments, after which new data
+        # is sent once, rather than after every ACK in it.
+        self._in_batch = False
+
+        # Only start the network thread once all state it touches exists.
+        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT,
+                                       SERVER_IP, SERVER_PORT,
+                                       offload=UDP_OFFLOAD,
+                                       datagram_size=self._datagram_size())
+        logger.info("Socket initialized with sendbuf size %i, up to %i",
+                    self._sendbuf.capacity, self._max_sndbuf_size)
 
 
     ###########################################################################
@@ -103,33 +216,331 @@ class BTCPClientSocket(BTCPSocket):
         each elif.
         """
         logger.debug("lossy_layer_segment_received called")
-        # raise NotImplementedError("No implementation of lossy_layer_segment_received present. Read the comments & code of client_socket.py.")
 
-        if not self.verify_checksum(segment):
-            logger.error("invalid checksum")
-
-        seq_num, ack_num, syn_set, ack_set, fin_set, window, btcp_length, checksum = self.unpack_segment_header(segment)
-        data = segment[:btcp_length]
+        if not self.verify_segment(segment):
+            logger.warning("Dropping segment with invalid length or checksum")
+            return
+        unpacked = self._unpack_segment(segment)
+        if unpacked is None:
+            logger.warning("Dropping segment without sequence number "
+                           "extension")
+            return
+        ((seqnum, acknum, syn_set, ack_set, fin_set,
+          window, length, checksum), payload) = unpacked
 
         match self._state:
             case BTCPStates.SYN_SENT:
-                # recv SYN|ACK send ACK to server
-                if syn_set and ack_set:
-                    self._state = BTCPStates.ESTABLISHED
-                    response_segment = self.build_segment_header(ack_num, seq_num + 1, False, True, False, window, btcp_length, checksum)
-                    LossyLayer.send_segment(response_segment)
-                elif syn_set:
-                    "process segment"
+                if syn_set and ack_set and acknum == self._send_base & 0xFFFF:
+                    self._established(seqnum, window, payload)
             case BTCPStates.ESTABLISHED:
-                if ack_set:
-                    "process segment"
+                if syn_set and ack_set:
+                    # The server did not get our handshake ACK yet.
+                    logger.debug("Duplicate SYN|ACK, acknowledging again")
+                    self._send_ack()
+                elif ack_set:
+                    timestamp = None
+                    if self._timestamps and length >= codec.TIMESTAMP.size:
+                        timestamp, = codec.TIMESTAMP.unpack_from(payload)
+                        payload = payload[codec.TIMESTAMP.size:]
+                    self._ack_received(
+                        serial.unwrap(acknum, self._send_base, self._seq_bits),
+                        window)
+                    if payload and self._sack_blocks:
+                        self._sack_received(payload)
+                    self._report_delivered(timestamp)
             case BTCPStates.FIN_SENT:
-                # recv FIN|ACK send ACK to server
-                if ack_set and fin_set:
+                fin = self._next_seq + 1
+                if syn_set and ack_set:
+                    logger.debug("Duplicate SYN|ACK, acknowledging again")
+                    self._send_ack()
+                elif (fin_set and ack_set and fin == serial.unwrap(
+                        acknum, fin, self._seq_bits)):
+                    self._acknum = serial.unwrap(seqnum, self._acknum,
+                                                 self._seq_bits) + 1
+                    self._send_ack(fin)
+                    self._control = None
                     self._state = BTCPStates.CLOSED
-                    response_segment = self.build_segment_header(seq_num, ack_num, False, True, False, window, btcp_length, checksum)
-                    LossyLayer.send_segment(response_segment)
+                    logger.info("Connection closed")
+            case _:
+                logger.debug("Ignoring segment in %s state", self._state)
+
+        self._expire_timers()
+        # ACK clocking: fill the room the ACK made in the window right away.
+        if not self._in_batch and self._state == BTCPStates.ESTABLISHED:
+            self._transmit()
+
+
+    def lossy_layer_segments_received(self, segments):
+        """Handle a batch of segments drained from the network, then fill
+        the room all ACKs among them made in the window in one burst.
+        """
+        self._in_batch = True
+        try:
+            super().lossy_layer_segments_received(segments)
+        finally:
+            self._in_batch = False
+        if self._state == BTCPStates.ESTABLISHED:
+            self._transmit()
+
 
+    def _established(self, seqnum, window, options):
+        """Handle the server's SYN|ACK: apply the options it confirmed,
+        acknowledge it and start sending data.
+        """
+        options = self._negotiate(options)
+        if self._retries == 0:
+            self._rtt_sample((time.monotonic_ns() - self._control_sent)
+                             / 1_000_000)
+        self._acknum = self._peer_isn(seqnum, options) + 1
+        self._peer_window = window
+        self._control = None
+        self._retries = 0
+        self._send_ack()
+        self._state = BTCPStates.ESTABLISHED
+        logger.info("Connection established")
+
+
+    def _ack_received(self, acknum, window):
+        """Slide the send window up to the cumulative (unwrapped) acknum,
+        releasing the acknowledged segments from the ring. Duplicate and
+        stale ACKs only update the peer's window.
+
+        The newest acknowledged segment yields an RTT sample, unless it was
+        retransmitted (Karn's rule) or selectively acknowledged before: then
+        this ACK was not triggered by its arrival.
+
+        Duplicate ACKs while data is in flight mean segments after the
+        oldest one arrived; after _dupthresh of them the oldest one is fast
+        retransmitted. If it then turns out to have been merely reordered,
+        _dupthresh is raised so the same reordering is tolerated next time.
+        Without SACK, that is only noticed if the oldest segment arrives
+        before it was retransmitted. As in RFC 5681, an ACK that changes the
+        window is a window update, e.g. after recv made room, not a
+        duplicate. In fast recovery, an ACK short of _recover is a partial
+        ACK, see _partial_ack.
+        """
+        window <<= self._peer_window_shift
+        updated = window != self._peer_window
+        self._peer_window = window
+        acked = acknum - self._send_base
+        if acked == 0 and self._send_base < self._next_seq:
+            if updated:
+                logger.debug("Window update to %i", window)
+                return
+            self._dupacks += 1
+            head = self._ring[self._send_base % self._window]
+            if self._dupacks >= self._dupthresh and not head.retransmitted:
+                logger.info("%i duplicate ACKs, fast retransmit",
+                            self._dupacks)
+                now = time.monotonic_ns()
+                self._loss_detected(now)
+                self._retransmit(self._send_base, now, fast=True)
+                if not self._sack_blocks:
+                    self._inflation = self._dupacks
+            elif self._fast_recovery and not self._sack_blocks:
+                self._inflation += 1
+            return
+        if not 0 < acked <= self._next_seq - self._send_base:
+            logger.debug("Stale ACK %i", acknum)
+            return
+        now = time.monotonic_ns()
+        head = self._ring[self._send_base % self._window]
+        if not head.retransmitted:
+            # The oldest segment arrived after later ones without being
+            # retransmitted: it was reordered by at least this many.
+            extent = max(self._dupacks, self._sacked)
+            if extent:
+                self._reordering_detected(extent + 1)
+        newest = self._ring[(self._send_base + acked - 1) % self._window]
+        if not newest.retransmitted and not newest.sacked:
+            self._rtt_sample((now - newest.sent) / 1_000_000)
+            self._delivered_sent = newest.sent
+        released = 0
+        for seqnum in range(self._send_base, self._send_base + acked):
+            entry = self._ring[seqnum % self._window]
+            self._sacked -= entry.sacked
+            self._delivered += not entry.sacked
+            self._lost -= entry.lost
+            released += len(entry.payload)
+            self._ring[seqnum % self._window] = None
+        self._sendbuf.consume(released)
+        self._send_base += acked
+        self._ordered += acked
+        if self._ordered >= self._window:
+            # A window's worth without reordering: lower the threshold
+            # again, so a route that stopped reordering is not stuck with
+            # slow loss detection.
+            self._ordered = 0
+            if self._dupthresh > DUPACK_THRESHOLD:
+                self._dupthresh -= 1
+                logger.debug("Duplicate ACK threshold decays to %i",
+                             self._dupthresh)
+        self._retransmitted = {
+            seqnum: fast for seqnum, fast in self._retransmitted.items()
+            if seqnum >= self._send_base - self._window}
+        self._dupacks = 0
+        self._retries = 0
+        if self._send_base >= self._recover:
+            self._fast_recovery = False
+            self._inflation = 0
+        if self._send_base == self._next_seq:
+            self._rto_deadline = None
+        else:
+            self._rto_deadline = now + self._rto_ns()
+        if self._fast_recovery:
+            self._partial_ack(acked, now)
+
+
+    def _partial_ack(self, acked, now):
+        """Handle an ACK in fast recovery that acknowledged acked segments,
+        but not everything up to _recover (RFC 6582). The new oldest segment
+        was lost as well: retransmit it right away, rather than wait for
+        duplicate ACKs that may not come, or for a timeout. The window is
+        deflated by the segments acknowledged, which had inflated it as
+        duplicate ACKs, and inflated by one for the retransmission.
+        """
+        head = self._ring[self._send_base % self._window]
+        if not head.retransmitted:
+            logger.info("Partial ACK, retransmitting segment %i",
+                        self._send_base)
+            self._retransmit(self._send_base, now, fast=True)
+        if not self._sack_blocks:
+            self._inflation += 1 - acked
+
+
+    def _sack_received(self, payload):
+        """Mark the segments in the SACK blocks of an ACK payload on the
+        scoreboard, then mark every hole that is now considered lost and was
+        not retransmitted yet as lost. _transmit retransmits them, oldest
+        first and as far as the congestion window allows -- all missing
+        ranges within a round trip, rather than one per retransmission
+        timeout.
+
+        Only the blocks are walked to find the segment with _dupthresh
+        sacked segments at or above it, below which every hole is lost.
+        The holes below it are then walked from _marked, where the previous
+        ACK left off, so every segment is looked at only once.
+        """
+        now = time.monotonic_ns()
+        blocks = codec.unpack_sack_blocks(payload)
+        if blocks and self._is_dsack(blocks):
+            self._dsack_received(blocks.pop(0)[0])
+        ranges = []
+        for start, end in blocks:
+            first = serial.unwrap(start, self._send_base)
+            last = first + serial.diff(end, start)
+            if not self._send_base <= first < last <= self._next_seq:
+                logger.debug("Ignoring stale SACK block %i-%i", start, end)
+                continue
+            ranges.append((first, last))
+            newest = None
+            for seqnum in range(first, last):
+                entry = self._ring[seqnum % self._window]
+                if not entry.sacked:
+                    entry.sacked = True
+                    self._sacked += 1
+                    self._delivered += 1
+                    if entry.lost:
+                        entry.lost = False
+                        self._lost -= 1
+                    newest = entry
+            # Segments newly covered by a SACK block just arrived, so the
+            # newest of them yields an RTT sample just like a cumulative ACK.
+            if newest is not None and not newest.retransmitted:
+                self._rtt_sample((now - newest.sent) / 1_000_000)
+                self._delivered_sent = newest.sent
+
+        sacked = 0
+        for first, last in sorted(ranges, reverse=True):
+            sacked += last - first
+            if sacked >= self._dupthresh:
+                threshold = first + sacked - self._dupthresh
+                break
+        else:
+            return
+        lost = False
+        for seqnum in range(max(self._marked, self._send_base), threshold):
+            entry = self._ring[seqnum % self._window]
+            if not (entry.sacked or entry.retransmitted or entry.lost):
+                entry.lost = True
+                self._lost += 1
+                lost = True
+        self._marked = max(self._marked, threshold)
+        if lost:
+            self._loss_detected(now)
+
+
+    def _report_delivered(self, timestamp=None):
+        """Tell congestion control how many segments the ACK just processed
+        newly delivered, cumulatively or selectively.
+
+        With the ACK's receive timestamp, the newest of them also yields a
+        one-way delay sample: from when we sent it to when the server
+        acknowledged it, plus the unknown offset between our clocks.
+        """
+        now = time.monotonic()
+        if timestamp is not None and self._delivered_sent is not None:
+            delay = timestamp - self._delivered_sent // 1000
+            if self._delay_origin is None:
+                self._delay_origin = delay
+            # Relative to the first sample, in signed 32-bit arithmetic, so
+            # the wrapping timestamp does not make the delay jump.
+            offset = (delay - self._delay_origin + 0x80000000) & 0xFFFFFFFF
+            self._congestion.on_delay((offset - 0x80000000) / 1e6, now)
+        self._delivered_sent = None
+        if self._delivered:
+            self._congestion.on_ack(self._delivered,
+                                    self._srtt and self._srtt / 1000,
+                                    now, self._fast_recovery)
+            self._delivered = 0
+
+
+    def _loss_detected(self, now):
+        """Report a loss to congestion control, unless it belongs to a
+        congestion event that was already reported."""
+        if self._send_base >= self._recover:
+            self._recover = self._next_seq
+            self._fast_recovery = True
+            self._congestion.on_loss(self._next_seq - self._send_base,
+                                     now / 1e9)
+            logger.debug("Loss detected, cwnd now %.1f",
+                         self._congestion.cwnd)
+
+
+    def _is_dsack(self, blocks):
+        """Whether the first SACK block is a D-SACK block (RFC 2883),
+        reporting a duplicate segment: it lies below the cumulative ACK, or
+        within the second block."""
+        start, end = blocks[0]
+        if -self._window <= serial.diff(start, self._send_base) < 0:
+            return True
+        if len(blocks) > 1:
+            size = serial.diff(blocks[1][1], blocks[1][0])
+            return (0 <= serial.diff(start, blocks[1][0]) < size
+                    and 0 < serial.diff(end, blocks[1][0]) <= size)
+        return False
+
+
+    def _dsack_received(self, start):
+        """The server received segment start twice. If we retransmitted it
+        only once, fast, the original was not lost but reordered."""
+        seqnum = serial.unwrap(start, self._send_base)
+        if self._retransmitted.get(seqnum):
+            logger.info("Spurious fast retransmit of segment %i", seqnum)
+            self._retransmitted[seqnum] = False
+            self._reordering_detected(self._dupthresh + 1)
+
+
+    def _reordering_detected(self, threshold):
+        """Raise the duplicate ACK threshold to threshold, within bounds: at
+        most window - 1 segments can be acknowledged beyond a hole, so a
+        higher threshold would never fire."""
+        self._ordered = 0
+        threshold = min(threshold, MAX_DUPACK_THRESHOLD, self._window - 1)
+        if threshold > self._dupthresh:
+            logger.info("Reordering detected, duplicate ACK threshold "
+                        "raised to %i", threshold)
+            self._dupthresh = threshold
 
 
     def lossy_layer_tick(self):
@@ -139,7 +550,9 @@ class BTCPClientSocket(BTCPSocket):
         NOTE: Will NOT be called if segments are arriving; do not rely on
         simply counting calls to this method for an accurate timeout. If 10
         segments arrive, each 99 ms apart, this method will NOT be called for
-        over a second!
+        over a second! Except: send() and shutdown() wake the network thread
+        to call it right away, so new data goes out without waiting for the
+        network to go quiet.
 
         The primary use for this method is to be able to do things in the
         "network thread" even while no segments are arriving -- which would
@@ -157,32 +570,275 @@ class BTCPClientSocket(BTCPSocket):
         lossy_layer_segment_received or lossy_layer_tick.
         """
         logger.debug("lossy_layer_tick called")
-        raise NotImplementedError("Only rudimentary implementation of lossy_layer_tick present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+        self._expire_timers()
+        if self._state == BTCPStates.ESTABLISHED:
+            self._transmit()
+
+
+    def lossy_layer_timeout(self):
+        """Seconds until the first of the retransmission timer, the persist
+        timer, the SYN or FIN retransmission and the segment pacing holds
+        back is due, so the lossy layer ticks in time for it; None if none
+        is pending.
+        """
+        deadlines = [self._rto_deadline, self._persist_deadline]
+        if self._control is not None:
+            deadlines.append(self._control_deadline)
+        if self._state == BTCPStates.ESTABLISHED:
+            deadlines.append(self._pacing_deadline)
+        deadlines = [deadline for deadline in deadlines
+                     if deadline is not None]
+        if not deadlines:
+            return None
+        return (min(deadlines) - time.monotonic_ns()) / 1e9
+
+
+    def _transmit(self):
+        """Turn chunks from the send buffer into segments for as long as the
+        window has room, and send them in one burst. Once the application
+        asked to shut down and everything was acknowledged, send the FIN.
+        Called on every tick and after every (batch of) ACKs.
+
+        The number of segments in flight -- sent, and neither acknowledged,
+        selectively acknowledged nor considered lost -- is kept below the
+        congestion window; segments considered lost are retransmitted first.
+        New segments are also limited by our ring and the server's
+        advertised window. If congestion control asks for pacing, new
+        segments are additionally spaced out at its rate.
+        """
+        window = min(self._window, self._peer_window)
+        cwnd = max(1, self._congestion.window + self._inflation)
+        rate = self._congestion.pacing_rate()
+        segments = []
+        now = time.monotonic_ns()
+        in_flight = (self._next_seq - self._send_base
+                     - self._sacked - self._lost)
+        seqnum = self._send_base
+        while self._lost and in_flight < cwnd:
+            if self._ring[seqnum % self._window].lost:
+                # Found by the SACK scoreboard in fast recovery, or else
+                # after a retransmission timeout.
+                self._retransmit(seqnum, now, fast=self._fast_recovery)
+                in_flight += 1
+            seqnum += 1
+        if rate:
+            # We run on segment arrivals, and on ticks when the next paced
+            # segment is due (see lossy_layer_timeout), but may run late:
+            # catch up on at most one tick's worth of segments owed.
+            self._pacing_next = max(self._pacing_next,
+                                    now - TIMER_TICK * 1_000_000)
+        self._pacing_deadline = None
+        self._grow_send_buffer(min(cwnd, window))
+        while self._next_seq - self._send_base < window and in_flight < cwnd:
+            if rate and now < self._pacing_next:
+                if self._unsent():
+                    self._pacing_deadline = self._pacing_next
+                break
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            logger.debug("Building segment %i from chunk with length %i",
+                         self._next_seq, len(chunk))
+            # Header and chunk are sent as separate buffers; the chunk, a
+            # view into the send buffer, is never copied into a combined
+            # segment, nor padded.
+            header, payload = self.build_segment_parts(
+                self._next_seq & 0xFFFF, self._acknum & 0xFFFF, ack_set=True,
+                window=self._advertised_window(), payload=chunk,
+                prefix=self._extension(self._next_seq, self._acknum))
+            self._ring[self._next_seq % self._window] = _SentSegment(
+                self._next_seq, header, payload, now)
+            segments.append((header, payload))
+            self._next_seq += 1
+            in_flight += 1
+            if rate:
+                self._pacing_next += int(1e9 / rate)
+        if segments:
+            if self._rto_deadline is None:
+                self._rto_deadline = now + self._rto_ns()
+            # Send everything in one burst, so the lossy layer can pack
+            # segments into as few datagrams as the peer agreed to.
+            logger.debug("Sending %i segments", len(segments))
+            self._lossy_layer.send_segments(segments,
+                                            self._segments_per_datagram)
+        if (self._signal == BTCPSignals.SHUTDOWN
+                and self._send_base == self._next_seq
+                and not self._unsent()):
+            self._send_fin()
+
+
+    def _unsent(self):
+        """Bytes in the send buffer, not yet turned into segments."""
+        return self._sendbuf.tail - self._send_next
+
+
+    def _next_chunk(self):
+        """Return the payload of the next segment, from the send buffer, or
+        None if it holds nothing more to send.
+
+        The payload is as large as a segment can carry, or as what is left.
+        A stream of small send() calls thus still makes full-size segments
+        out of whatever piled up since we last ran, rather than each
+        becoming a small segment of its own.
+        """
+        size = min(self._unsent(), self._max_payload)
+        if not size:
+            return None
+        chunk = self._sendbuf.peek(self._send_next, size)
+        self._send_next += size
+        return chunk
+
+
+    def _grow_send_buffer(self, window):
+        """Grow the send buffer to twice the window segments the connection
+        can now have in flight, up to its ceiling: enough to fill the next
+        window while the current one is on its way, so send() is not what
+        limits the transfer. Congestion control keeps its window close to
+        the bandwidth-delay product it measures, so this follows it.
+
+        Like Linux's send buffer, it never shrinks: the space is only ever
+        taken up by data the application has to send anyway.
+        """
+        size = min(2 * int(window) * self._max_payload, self._max_sndbuf_size)
+        if size > self._sendbuf.capacity:
+            logger.debug("Send buffer grows to %i bytes", size)
+            self._sendbuf.resize(size)
 
-        # Actually send all chunks available for sending.
-        # Relies on an eventual exception to break from the loop when no data
-        # is available.
-        # You should be checking whether there's space in the window as well,
-        # and storing the segments for retransmission somewhere.
-        try:
-            while True:
-                logger.debug("Getting chunk from buffer.")
-                chunk = self._sendbuf.get_nowait()
-                datalen = len(chunk)
-                logger.debug("Got chunk with lenght %i:",
-                             datalen)
-                logger.debug(chunk)
-                if datalen < PAYLOAD_SIZE:
-                    logger.debug("Padding chunk to full size")
-                    chunk = chunk + b'\x00' * (PAYLOAD_SIZE - datalen)
-                logger.debug("Building segment from chunk.")
-                segment = (self.build_segment_header(0, 0, length=datalen)
-                           + chunk)
-                logger.info("Sending segment.")
-                self._lossy_layer.send_segment(segment)
-        except queue.Empty:
-            logger.info("No (more) data was available for sending right now.")
 
+    def _expire_timers(self):
+        """Retransmit the pending SYN or FIN, or the oldest unacknowledged
+        data segment, if its timer expired. Called from both
+        lossy_layer_segment_received and lossy_layer_tick, because the tick
+        does not happen while segments keep arriving.
+        """
+        now = time.monotonic_ns()
+        control = self._control
+        if control is not None and now >= self._control_deadline:
+            if self._retries >= MAX_RETRIES:
+                self._abort()
+                return
+            logger.info("Retransmitting %s segment", self._state.name)
+            self._retries += 1
+            self._rto_backoff()
+            self._control_deadline = now + self._rto_ns()
+            self._lossy_layer.send_segment(control)
+        if self._rto_deadline is not None and now >= self._rto_deadline:
+            if self._retries >= MAX_RETRIES:
+                self._abort()
+                return
+            # After a timeout, everything not selectively acknowledged is
+            # considered lost, and retransmitted by _transmit as the
+            # congestion window grows again.
+            for seqnum in range(self._send_base, self._next_seq):
+                entry = self._ring[seqnum % self._window]
+                if not entry.sacked and not entry.lost:
+                    entry.lost = True
+                    entry.retransmitted = False
+                    self._lost += 1
+            self._congestion.on_rto(self._next_seq - self._send_base,
+                                    now / 1e9)
+            self._recover = self._next_seq
+            self._fast_recovery = False
+            self._inflation = 0
+            self._rto_backoff()
+            self._retransmit(self._send_base, now)
+        self._persist(now)
+
+
+    def _persist(self, now):
+        """Probe the server's window if it has been zero for a while, with
+        nothing in flight whose ACK could open it and data waiting to be
+        sent. The server answers a probe with an ACK carrying its current
+        window, so a lost window update cannot stall the connection.
+
+        Like TCP, we keep probing for as long as the window stays closed,
+        with the interval backed off up to MAX_RTO.
+        """
+        if (self._state != BTCPStates.ESTABLISHED or self._peer_window
+                or self._send_base != self._next_seq
+                or not self._unsent()):
+            self._persist_deadline = None
+            self._probes = 0
+        elif self._persist_deadline is None:
+            self._persist_deadline = now + self._rto_ns()
+        elif now >= self._persist_deadline:
+            logger.info("Zero window, probing the server")
+            self._probes += 1
+            self._persist_deadline = now + min(self._rto_ns() << self._probes,
+                                               MAX_RTO * 1_000_000)
+            self._send_ack()
+
+
+    def _retransmit(self, seqnum, now, fast=False):
+        """Resend the stored segment seqnum: the original payload buffer with
+        its header refreshed in place, so nothing is copied or rechecksummed
+        over the payload. fast marks a retransmission triggered by duplicate
+        ACKs or the SACK scoreboard rather than by the timer.
+        """
+        entry = self._ring[seqnum % self._window]
+        logger.info("Retransmitting segment %i", seqnum)
+        # The extension in the header buffer needs no refresh: the server
+        # sends no data, so _acknum no longer changes once established.
+        self.refresh_segment_header(entry.header, self._acknum & 0xFFFF,
+                                    self._advertised_window())
+        entry.sent = now
+        entry.retransmitted = True
+        if entry.lost:
+            entry.lost = False
+            self._lost -= 1
+        self._retransmitted[seqnum] = (fast
+                                       and seqnum not in self._retransmitted)
+        if seqnum == self._send_base:
+            self._retries += 1
+            self._rto_deadline = now + self._rto_ns()
+        self._lossy_layer.send_segment((entry.header, entry.payload))
+
+
+    def _send_ack(self, seqnum=None):
+        """Send a pure ACK for everything received from the server."""
+        if seqnum is None:
+            seqnum = self._send_base
+        self._lossy_layer.send_segment(self.build_segment(
+            seqnum & 0xFFFF, self._acknum & 0xFFFF, ack_set=True,
+            window=self._advertised_window(),
+            payload=self._extension(seqnum, self._acknum)))
+
+
+    def _send_fin(self):
+        """Send the FIN, which like every segment after the handshake also
+        acknowledges the server's SYN|ACK: if our ACK of that got lost and
+        no data followed it, the FIN completes the handshake."""
+        logger.info("All data acknowledged, sending FIN")
+        self._control_deadline = time.monotonic_ns() + self._rto_ns()
+        self._control = self.build_segment(
+            self._next_seq & 0xFFFF, self._acknum & 0xFFFF, ack_set=True,
+            fin_set=True, window=self._advertised_window(),
+            payload=self._extension(self._next_seq, self._acknum))
+        self._retries = 0
+        self._state = BTCPStates.FIN_SENT
+        self._lossy_layer.send_segment(self._control)
+
+
+    def _abort(self):
+        logger.error("No response from the server after %i retransmissions, "
+                     "aborting the connection in %s state",
+                     self._retries, self._state.name)
+        self._control = None
+        self._rto_deadline = None
+        self._state = BTCPStates.CLOSED
+
+
+    def _rtt_sample(self, rtt):
+        """Also pass every RTT sample on to congestion control."""
+        super()._rtt_sample(rtt)
+        self._congestion.on_rtt(rtt / 1000, time.monotonic())
+
+
+    @property
+    def congestion(self):
+        """The congestion control algorithm instance, e.g. to read its cwnd
+        or set its trace attribute."""
+        return self._congestion
 
 
     ###########################################################################
@@ -235,7 +891,26 @@ class BTCPClientSocket(BTCPSocket):
         this project.
         """
         logger.debug("connect called")
-        raise NotImplementedError("No implementation of connect present. Read the comments & code of client_socket.py.")
+        if self._state != BTCPStates.CLOSED:
+            raise ConnectionError("Socket is already connected")
+        # The SYN takes up our ISN; the first data segment gets ISN + 1.
+        self._send_base = self._next_seq = self._isn + 1
+        self._retries = 0
+        self._control_sent = time.monotonic_ns()
+        self._control_deadline = self._control_sent + self._rto_ns()
+        self._control = self.build_segment(self._isn & 0xFFFF, 0,
+                                           syn_set=True,
+                                           window=self._advertised_window(),
+                                           payload=self._syn_options())
+        self._state = BTCPStates.SYN_SENT
+        logger.info("Sending SYN")
+        self._lossy_layer.send_segment(self._control)
+        # The network thread retransmits the SYN and moves us on to
+        # ESTABLISHED, or back to CLOSED if the server never answers.
+        while self._state == BTCPStates.SYN_SENT:
+            time.sleep(0.001)
+        if self._state != BTCPStates.ESTABLISHED:
+            raise ConnectionError("Could not connect to the server")
 
 
     def send(self, data):
@@ -260,32 +935,28 @@ class BTCPClientSocket(BTCPSocket):
         for sending.
 
         Again, you should feel free to deviate from how this usually works.
-        Note that our rudimentary implementation here already chunks the data
-        in maximum 1008-byte bytes objects because that's the maximum a segment
-        can carry. If a chunk is smaller we do *not* pad it here, that gets
-        done later.
+        Note that our implementation copies as much of the data as fits into
+        the send buffer in one go; the network thread cuts segments of at
+        most 1008 bytes out of it, because that's the maximum a segment can
+        carry (1004 with extended sequence numbers, whose extension takes up
+        the rest). If less is left it is sent as a shorter segment; bTCP
+        segments are never padded.
+
+        The send buffer is accounted in bytes, so the return value is exactly
+        the free space there was, however small the chunks the application
+        sends. Data stays in it until acknowledged. It grows with the
+        connection's window, see MAX_SEND_BUFFER.
         """
         logger.debug("send called")
-        raise NotImplementedError("Only rudimentary implementation of send present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+        if self._state == BTCPStates.CLOSED:
+            raise ConnectionError("Socket is not connected")
 
-        # Example with a finite buffer: a queue with at most 1000 chunks,
-        # for a maximum of 985KiB data buffered to get turned into packets.
-        # See BTCPSocket__init__() in btcp_socket.py for its construction.
         datalen = len(data)
         logger.debug("%i bytes passed to send", datalen)
-        sent_bytes = 0
         logger.info("Queueing data for transmission")
-        try:
-            while sent_bytes < datalen:
-                logger.debug("Cumulative data queued: %i bytes", sent_bytes)
-                # Slide over data using sent_bytes. Reassignments to data are
-                # too expensive when data is large.
-                chunk = data[sent_bytes:sent_bytes+PAYLOAD_SIZE]
-                logger.debug("Putting chunk in send queue.")
-                self._sendbuf.put_nowait(chunk)
-                sent_bytes += len(chunk)
-        except queue.Full:
-            logger.info("Send queue full.")
+        sent_bytes = self._sendbuf.write(data)
+        if sent_bytes:
+            self._lossy_layer.wakeup()
         logger.info("Managed to queue %i out of %i bytes for transmission",
                     sent_bytes,
                     datalen)
@@ -308,7 +979,15 @@ class BTCPClientSocket(BTCPSocket):
         more advanced thread synchronization in this project.
         """
         logger.debug("shutdown called")
-        raise NotImplementedError("No implementation of shutdown present. Read the comments & code of client_socket.py.")
+        if self._state == BTCPStates.CLOSED:
+            return
+        # The network thread sends the FIN once all buffered data has been
+        # sent and acknowledged, and closes the connection once the FIN is
+        # answered (or the server stops responding).
+        self._signal = BTCPSignals.SHUTDOWN
+        self._lossy_layer.wakeup()
+        while self._state != BTCPStates.CLOSED:
+            time.sleep(0.001)
 
 
     def close(self):
@@ -0,0 +1,220 @@
+"""Segment header codec shared by the bTCP sockets.
+
+The header layout is compiled once into a struct.Struct, so packing and
+unpacking do not re-parse the format string for every segment. Segments are
+packed straight into a (preallocated) bytearray with pack_into, and headers
+are decoded with unpack_from, which accepts any buffer -- including a
+memoryview into a larger receive buffer -- without slicing it first.
+
+Header layout, network byte order:
+    seqnum (16) | acknum (16) | flags (8) | window (8) | length (16) | checksum (16)
+"""
+
+
+import struct
+
+from btcp import checksum
+from btcp.constants import *
+
+
+HEADER = struct.Struct("!HHBBHH")
+CHECKSUM = struct.Struct("!H")
+CHECKSUM_OFFSET = 8
+
+SYN_FLAG = 0x04
+ACK_FLAG = 0x02
+FIN_FLAG = 0x01
+
+# (syn_set, ack_set, fin_set) for every possible value of the flags byte.
+FLAGS = tuple(((flags & SYN_FLAG) >> 2, (flags & ACK_FLAG) >> 1, flags & FIN_FLAG)
+              for flags in range(256))
+
+LENGTH = struct.Struct("!H")
+LENGTH_OFFSET = 6
+# acknum, flags and window: the 16-bit aligned part of the header that
+# changes when a stored segment is resent with fresh acknowledgement info.
+REFRESH = struct.Struct("!HBB")
+REFRESH_OFFSET = 2
+
+# Handshake options, carried in the payload of SYN segments as a sequence of
+# kind (8 bits), value length (8 bits), value. OPT_END (or the end of the
+# payload) ends the list.
+OPTION = struct.Struct("!BB")
+OPT_END = 0
+OPT_SEGMENTS_PER_DATAGRAM = 1
+OPT_SACK_PERMITTED = 2
+OPT_TIMESTAMPS = 3
+OPT_WINDOW_SCALE = 4
+OPT_EXTENDED_SEQ = 5
+
+# With extended sequence numbers, every segment but a SYN starts its payload
+# with the upper 16 bits of its seqnum and acknum.
+EXTENSION = struct.Struct("!HH")
+
+# Selective acknowledgement blocks, carried in the payload of ACK segments
+# once SACK has been negotiated: start seqnum and end seqnum (exclusive) of
+# a range of segments received beyond acknum.
+SACK_BLOCK = struct.Struct("!HH")
+
+# Receive timestamps, once negotiated, lead the payload of every ACK segment
+# (before any SACK blocks): the receiver's clock in microseconds, modulo
+# 2**32, when it sent the ACK.
+TIMESTAMP = struct.Struct("!I")
+
+
+def flag_byte(syn_set=False, ack_set=False, fin_set=False):
+    return syn_set << 2 | ack_set << 1 | fin_set
+
+
+def pack_header(seqnum, acknum,
+                syn_set=False, ack_set=False, fin_set=False,
+                window=0x01, length=0, checksum=0):
+    return HEADER.pack(seqnum, acknum, flag_byte(syn_set, ack_set, fin_set),
+                       window, length, checksum)
+
+
+def pack_header_into(buffer, offset, seqnum, acknum,
+                     syn_set=False, ack_set=False, fin_set=False,
+                     window=0x01, length=0, checksum=0):
+    HEADER.pack_into(buffer, offset, seqnum, acknum,
+                     flag_byte(syn_set, ack_set, fin_set),
+                     window, length, checksum)
+
+
+def unpack_header(buffer, offset=0):
+    """Decode the header at offset in buffer into
+    seqnum, acknum, syn_set, ack_set, fin_set, window, length, checksum.
+    """
+    seqnum, acknum, flags, window, length, cksum = HEADER.unpack_from(buffer,
+                                                                      offset)
+    syn_set, ack_set, fin_set = FLAGS[flags]
+    return seqnum, acknum, syn_set, ack_set, fin_set, window, length, cksum
+
+
+def refresh_field(segment, offset, field, *values):
+    """Rewrite the field (a struct.Struct) at the 16-bit aligned offset of
+    the complete, checksummed segment (a bytearray) with values, in place,
+    patching its checksum incrementally instead of recomputing it over the
+    whole segment.
+    """
+    end = offset + field.size
+    old = bytes(segment[offset:end])
+    field.pack_into(segment, offset, *values)
+    cksum, = CHECKSUM.unpack_from(segment, CHECKSUM_OFFSET)
+    CHECKSUM.pack_into(segment, CHECKSUM_OFFSET,
+                       checksum.update(cksum, old, segment[offset:end]))
+
+
+def refresh_header(header, acknum, window):
+    """Rewrite acknum and window of the complete, checksummed header (a
+    bytearray) in place, like refresh_field.
+    """
+    refresh_field(header, REFRESH_OFFSET, REFRESH, acknum, header[4], window)
+
+
+def refresh_timestamp(segment, timestamp, offset=HEADER_SIZE):
+    """Rewrite the receive timestamp at offset (by default, leading the
+    payload) of the complete, checksummed segment, like refresh_field.
+    """
+    refresh_field(segment, offset, TIMESTAMP, timestamp & 0xFFFFFFFF)
+
+
+def pack_segment_into(buffer, seqnum, acknum,
+                      syn_set=False, ack_set=False, fin_set=False,
+                      window=0x01, payload=b''):
+    """Write a complete, checksummed segment carrying payload to the start of
+    buffer and return its size, HEADER_SIZE + len(payload).
+
+    Segments are not padded: a segment is exactly as long as its header says.
+    """
+    length = len(payload)
+    end = HEADER_SIZE + length
+    buffer[HEADER_SIZE:end] = payload
+    pack_header_into(buffer, 0, seqnum, acknum, syn_set, ack_set, fin_set,
+                     window, length)
+    view = buffer if len(buffer) == end else memoryview(buffer)[:end]
+    CHECKSUM.pack_into(buffer, CHECKSUM_OFFSET, checksum.in_cksum(view))
+    return end
+
+
+def build_segment_parts(seqnum, acknum,
+                        syn_set=False, ack_set=False, fin_set=False,
+                        window=0x01, payload=b'', prefix=b''):
+    """Return a (header, payload) tuple of buffers that together make up a
+    complete, checksummed segment, for LossyLayer.send_segment.
+
+    Only the header is newly allocated; payload is passed through as given.
+    prefix, of even length, goes into the header buffer right after the
+    header proper, ahead of the payload. The checksum is computed over
+    header and payload as separate parts.
+    """
+    length = len(prefix) + len(payload)
+    header = bytearray(HEADER_SIZE + len(prefix))
+    header[HEADER_SIZE:] = prefix
+    pack_header_into(header, 0, seqnum, acknum, syn_set, ack_set, fin_set,
+                     window, length)
+    CHECKSUM.pack_into(header, CHECKSUM_OFFSET,
+                       checksum.in_cksum(header, payload))
+    return header, payload
+
+
+def build_segment(seqnum, acknum,
+                  syn_set=False, ack_set=False, fin_set=False,
+                  window=0x01, payload=b''):
+    """Allocate a new segment and fill it like pack_segment_into."""
+    segment = bytearray(HEADER_SIZE + len(payload))
+    pack_segment_into(segment, seqnum, acknum, syn_set, ack_set, fin_set,
+                      window, payload)
+    return segment
+
+
+def segment_length(buffer, offset=0):
+    """Return the size of the segment at offset in buffer according to its
+    header: HEADER_SIZE plus the length field."""
+    return HEADER_SIZE + LENGTH.unpack_from(buffer, offset + LENGTH_OFFSET)[0]
+
+
+def valid_length(segment):
+    """Whether segment is exactly as long as its header says."""
+    return (HEADER_SIZE <= len(segment) <= SEGMENT_SIZE
+            and segment_length(segment) == len(segment))
+
+
+def pack_options(options):
+    """Encode a {kind: value bytes} dict of handshake options."""
+    return b''.join(OPTION.pack(kind, len(value)) + value
+                    for kind, value in options.items())
+
+
+def unpack_options(payload):
+    """Decode handshake options into a {kind: value bytes} dict.
+
+    Parsing stops at OPT_END or at the first option that does not fit in
+    payload, so a peer sending garbage cannot make this raise.
+    """
+    options = {}
+    offset = 0
+    while offset + OPTION.size <= len(payload):
+        kind, length = OPTION.unpack_from(payload, offset)
+        offset += OPTION.size
+        if kind == OPT_END or offset + length > len(payload):
+            break
+        options[kind] = bytes(payload[offset:offset + length])
+        offset += length
+    return options
+
+
+def pack_sack_blocks(blocks):
+    """Encode (start, end) ranges of sequence numbers, reduced to 16 bits."""
+    payload = bytearray(SACK_BLOCK.size * len(blocks))
+    for index, (start, end) in enumerate(blocks):
+        SACK_BLOCK.pack_into(payload, index * SACK_BLOCK.size,
+                             start & 0xFFFF, end & 0xFFFF)
+    return payload
+
+
+def unpack_sack_blocks(payload):
+    """Decode the SACK blocks in an ACK payload into a list of (start, end)
+    tuples. Trailing bytes that do not make up a whole block are ignored."""
+    end = len(payload) - len(payload) % SACK_BLOCK.size
+    return list(SACK_BLOCK.iter_unpack(payload[:end]))
@@ -0,0 +1,409 @@
+"""Congestion control algorithms for the bTCP client socket.
+
+The client socket keeps the bookkeeping (what is in flight, what was lost,
+round trip times) and reports events to a CongestionControl instance through
+its hooks; the algorithm only decides how large the congestion window is,
+and optionally at what rate segments should be paced out. The client sends
+at most min(cwnd, window advertised by the server) segments unacknowledged.
+
+Windows count segments, not bytes, like everything else in bTCP. Times are
+in seconds, from time.monotonic().
+
+Algorithms are selected by name through create(); ALGORITHMS lists them.
+"""
+
+
+import collections
+
+from btcp.constants import *
+
+
+class CongestionControl:
+    """Interface of a congestion control algorithm; subclasses implement
+    the hooks.
+
+    cwnd may be fractional; the client socket rounds it down, but never
+    below one segment. It never grows beyond max_window, which the client
+    socket sets to the size of its send ring: more could not be in flight
+    anyway. Set trace to a list to have every change of cwnd recorded in it
+    as a (time, cwnd, ssthresh) tuple, e.g. for plotting its evolution in a
+    benchmark.
+    """
+    name = None
+
+    def __init__(self, initial_window=INITIAL_CWND):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float('inf')
+        self.max_window = float('inf')
+        self.trace = None
+
+
+    @property
+    def window(self):
+        """The congestion window in whole segments."""
+        return max(1, int(self.cwnd))
+
+
+    def on_ack(self, acked, rtt, now, recovery):
+        """acked segments were newly delivered: acknowledged cumulatively or
+        selectively for the first time. rtt is the smoothed round trip time,
+        or None if not yet known. recovery is set while the losses of an
+        earlier on_loss are still being repaired.
+        """
+
+
+    def on_loss(self, inflight, now):
+        """A segment was found lost by duplicate ACKs or SACK, while inflight
+        segments were unacknowledged. Called once per window of data.
+        """
+
+
+    def on_rto(self, inflight, now):
+        """The retransmission timer expired with inflight segments
+        unacknowledged."""
+
+
+    def on_rtt(self, rtt, now):
+        """A new round trip time sample, in seconds, was measured."""
+
+
+    def on_delay(self, delay, now):
+        """A new one-way delay sample, in seconds, was measured towards the
+        receiver. Only differences between samples are meaningful: they are
+        off by a fixed but unknown amount, as the clocks of both ends are not
+        synchronized. Only called if the receiver timestamps its ACKs.
+        """
+
+
+    def pacing_rate(self):
+        """Rate, in segments per second, at which segments should be sent,
+        or None to send whatever the window allows at once."""
+        return None
+
+
+    def _update(self, now):
+        """Apply max_window to a changed cwnd, and trace it."""
+        self.cwnd = min(self.cwnd, self.max_window)
+        if self.trace is not None:
+            self.trace.append((now, self.cwnd, self.ssthresh))
+
+
+class NewReno(CongestionControl):
+    """Slow start and congestion avoidance, halving the window once per
+    window of data with losses (RFC 5681, RFC 6582)."""
+    name = "newreno"
+
+    def on_ack(self, acked, rtt, now, recovery):
+        if recovery:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self._update(now)
+
+
+    def on_loss(self, inflight, now):
+        self.ssthresh = max(inflight / 2, 2)
+        self.cwnd = self.ssthresh
+        self._update(now)
+
+
+    def on_rto(self, inflight, now):
+        self.ssthresh = max(inflight / 2, 2)
+        self.cwnd = 1
+        self._update(now)
+
+
+class Cubic(CongestionControl):
+    """CUBIC (RFC 8312): after a loss the window grows along a cubic function
+    of the time since, which is independent of the round trip time and
+    flattens out around the window at which the loss happened."""
+    name = "cubic"
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, initial_window=INITIAL_CWND):
+        super().__init__(initial_window)
+        self.w_max = 0.0
+        self.epoch_start = None
+        self.k = 0.0
+        self.origin = 0.0
+        self.w_est = 0.0
+
+
+    def on_ack(self, acked, rtt, now, recovery):
+        if recovery:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+            self._update(now)
+            return
+        rtt = rtt or 0.0
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0.0
+                self.origin = self.cwnd
+            self.w_est = self.cwnd
+        t = now - self.epoch_start + rtt
+        target = self.origin + self.C * (t - self.k) ** 3
+        # The window standard TCP would have by now, which CUBIC never
+        # falls behind ("TCP-friendly region").
+        self.w_est += (3 * (1 - self.BETA) / (1 + self.BETA)
+                       * acked / self.cwnd)
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+        self.cwnd = max(self.cwnd, self.w_est)
+        self._update(now)
+
+
+    def on_loss(self, inflight, now):
+        # Fast convergence: release bandwidth to new flows sooner if the
+        # window did not even get back to where the previous loss happened.
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.cwnd = self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.epoch_start = None
+        self._update(now)
+
+
+    def on_rto(self, inflight, now):
+        self.on_loss(inflight, now)
+        self.cwnd = 1
+        self._update(now)
+
+
+class BBR(CongestionControl):
+    """A BBR-like model-based algorithm: estimate the bottleneck bandwidth
+    (the highest recent delivery rate) and the minimum round trip time, pace
+    segments at the bandwidth and keep about twice the bandwidth-delay
+    product in flight. Random losses do not shrink the window; only the
+    model does.
+
+    Phases as in BBR v1: STARTUP doubles the rate every round until the
+    bandwidth stops growing, DRAIN empties the queue that built meanwhile,
+    PROBE_BW cycles the pacing gain around 1 to find more bandwidth, and
+    PROBE_RTT briefly cuts the window to refresh the minimum RTT.
+    """
+    name = "bbr"
+
+    STARTUP_GAIN = 2.89
+    PROBE_BW_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+    CWND_GAIN = 2
+    MIN_CWND = 4
+    BANDWIDTH_ROUNDS = 10       # rounds the bandwidth estimate lasts
+    MIN_RTT_LIFETIME = 10.0     # seconds before the minimum RTT is re-probed
+    PROBE_RTT_TIME = 0.2        # seconds at MIN_CWND to probe the RTT
+
+    def __init__(self, initial_window=INITIAL_CWND):
+        super().__init__(initial_window)
+        self.state = "STARTUP"
+        self.pacing_gain = self.STARTUP_GAIN
+        self.cwnd_gain = self.STARTUP_GAIN
+        self.delivered = 0
+        self.round = 0
+        self.round_start = None
+        self.round_delivered = 0
+        self.samples = []           # (round, delivery rate) of recent rounds
+        self.btl_bw = None          # segments per second
+        self.min_rtt = None         # seconds
+        self.min_rtt_stamp = None
+        self.full_bw = 0
+        self.full_bw_rounds = 0
+        self.cycle_index = 0
+        self.probe_rtt_done = None
+
+
+    def on_rtt(self, rtt, now):
+        if (self.min_rtt is None or rtt <= self.min_rtt
+                or now - self.min_rtt_stamp > self.MIN_RTT_LIFETIME):
+            self.min_rtt = max(rtt, 1e-6)
+            self.min_rtt_stamp = now
+
+
+    def on_ack(self, acked, rtt, now, recovery):
+        self.delivered += acked
+        if self.round_start is None:
+            self.round_start = now
+            self.round_delivered = self.delivered
+            return
+        round_time = self.min_rtt or rtt
+        if round_time and now - self.round_start >= round_time:
+            self._end_round(now)
+        self._set_cwnd(now)
+
+
+    def _end_round(self, now):
+        """Take a delivery rate sample over the round that just ended, and
+        advance the state machine."""
+        rate = (self.delivered - self.round_delivered) / (now - self.round_start)
+        self.round += 1
+        self.round_start = now
+        self.round_delivered = self.delivered
+        self.samples = [(r, bw) for r, bw in self.samples
+                        if r > self.round - self.BANDWIDTH_ROUNDS]
+        self.samples.append((self.round, rate))
+        self.btl_bw = max(bw for _, bw in self.samples)
+
+        if self.state == "STARTUP":
+            if self.btl_bw >= self.full_bw * 1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_rounds = 0
+            else:
+                self.full_bw_rounds += 1
+                if self.full_bw_rounds >= 3:
+                    self.state = "DRAIN"
+                    self.pacing_gain = 1 / self.STARTUP_GAIN
+                    self.cwnd_gain = self.STARTUP_GAIN
+        elif self.state == "DRAIN":
+            self._enter_probe_bw()
+        elif self.state == "PROBE_BW":
+            self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_BW_GAINS)
+            self.pacing_gain = self.PROBE_BW_GAINS[self.cycle_index]
+        elif self.state == "PROBE_RTT" and now >= self.probe_rtt_done:
+            self.min_rtt_stamp = now
+            self._enter_probe_bw()
+
+        if (self.state != "PROBE_RTT" and self.min_rtt_stamp is not None
+                and now - self.min_rtt_stamp > self.MIN_RTT_LIFETIME):
+            self.state = "PROBE_RTT"
+            self.pacing_gain = 1
+            self.probe_rtt_done = now + max(self.PROBE_RTT_TIME,
+                                            self.min_rtt or 0)
+
+
+    def _enter_probe_bw(self):
+        self.state = "PROBE_BW"
+        self.cycle_index = 0
+        self.pacing_gain = self.PROBE_BW_GAINS[0]
+        self.cwnd_gain = self.CWND_GAIN
+
+
+    def _set_cwnd(self, now):
+        if self.state == "PROBE_RTT":
+            self.cwnd = self.MIN_CWND
+        elif self.btl_bw is not None and self.min_rtt is not None:
+            bdp = self.btl_bw * self.min_rtt
+            self.cwnd = max(self.cwnd_gain * bdp, self.MIN_CWND)
+        elif self.state == "STARTUP":
+            self.cwnd += 1
+        self._update(now)
+
+
+    def on_loss(self, inflight, now):
+        # The model, not loss, limits the window.
+        pass
+
+
+    def on_rto(self, inflight, now):
+        # Restart from a minimal window; the next ACK restores it from the
+        # model.
+        self.cwnd = self.MIN_CWND
+        self._update(now)
+
+
+    def pacing_rate(self):
+        if self.btl_bw is None:
+            return None
+        return self.pacing_gain * self.btl_bw
+
+
+class Ledbat(CongestionControl):
+    """LEDBAT (RFC 6817), a scavenger for background transfers: it measures
+    the queuing delay it causes, as the current one-way delay minus the
+    lowest one seen (the base delay), and steers the window so that delay
+    stays at TARGET. Standard TCP flows sharing the bottleneck keep growing
+    the queue beyond that, so LEDBAT backs off and yields to them.
+
+    Without receive timestamps, round trip times stand in for the one-way
+    delays: the reverse path carries only ACKs, so its queue is small.
+    """
+    name = "ledbat"
+
+    TARGET = 0.06               # seconds; RFC 6817 allows at most 0.1
+    GAIN = 1
+    BASE_HISTORY = 10           # minutes the base delay is remembered
+    CURRENT_FILTER = 4          # samples the current delay is the minimum of
+    MIN_CWND = 2
+
+    def __init__(self, initial_window=INITIAL_CWND):
+        super().__init__(initial_window)
+        self.one_way = False
+        self.base_delays = []       # (minute, lowest delay in that minute)
+        self.current_delays = collections.deque(maxlen=self.CURRENT_FILTER)
+
+
+    def on_rtt(self, rtt, now):
+        if not self.one_way:
+            self._delay_sample(rtt, now)
+
+
+    def on_delay(self, delay, now):
+        if not self.one_way:
+            # Round trip times and one-way delays are not comparable.
+            self.one_way = True
+            self.base_delays.clear()
+            self.current_delays.clear()
+        self._delay_sample(delay, now)
+
+
+    def _delay_sample(self, delay, now):
+        minute = int(now // 60)
+        if self.base_delays and self.base_delays[-1][0] == minute:
+            if delay < self.base_delays[-1][1]:
+                self.base_delays[-1] = (minute, delay)
+        else:
+            self.base_delays.append((minute, delay))
+            del self.base_delays[:-self.BASE_HISTORY]
+        self.current_delays.append(delay)
+
+
+    @property
+    def queuing_delay(self):
+        """Estimated queuing delay in seconds, or None before any sample."""
+        if not self.current_delays:
+            return None
+        return (min(self.current_delays)
+                - min(delay for _, delay in self.base_delays))
+
+
+    def on_ack(self, acked, rtt, now, recovery):
+        queuing_delay = self.queuing_delay
+        if recovery or queuing_delay is None:
+            return
+        off_target = (self.TARGET - queuing_delay) / self.TARGET
+        self.cwnd += self.GAIN * off_target * acked / self.cwnd
+        self.cwnd = max(self.cwnd, self.MIN_CWND)
+        self._update(now)
+
+
+    def on_loss(self, inflight, now):
+        self.cwnd = self.ssthresh = max(self.cwnd / 2, self.MIN_CWND)
+        self._update(now)
+
+
+    def on_rto(self, inflight, now):
+        self.ssthresh = max(self.cwnd / 2, self.MIN_CWND)
+        self.cwnd = 1
+        self._update(now)
+
+
+ALGORITHMS = {cc.name: cc for cc in (NewReno, Cubic, BBR, Ledbat)}
+
+
+def create(name):
+    """Return a new instance of the congestion control algorithm name."""
+    try:
+        return ALGORITHMS[name]()
+    except KeyError:
+        raise ValueError("Unknown congestion control algorithm {!r}, "
+                         "choose from {}".format(name, ", ".join(ALGORITHMS)))
@@ -30,3 +30,168 @@ HEADER_SIZE, PAYLOAD_SIZE, SEGMENT_SIZE:
 HEADER_SIZE = 10
 PAYLOAD_SIZE = 1008
 SEGMENT_SIZE = HEADER_SIZE + PAYLOAD_SIZE
+
+"""
+RECV_BATCH:
+    Maximum number of datagrams the network thread drains from the UDP socket
+    after one wakeup before handing them to the bTCP socket as a single batch.
+    Bounds the time between calls into the socket under sustained load.
+"""
+RECV_BATCH = 64
+
+"""
+MAX_DATAGRAM_SIZE:
+    Largest UDP payload that fits in a single IPv4 datagram, in bytes. Upper
+    bound for datagrams carrying more than one segment, and the receive slot
+    size when the lossy layer runs in offload mode.
+"""
+MAX_DATAGRAM_SIZE = 65507
+
+"""
+SEGMENTS_PER_DATAGRAM:
+    Maximum number of complete segments (each with its own header and
+    checksum) this end offers to receive back to back in one UDP datagram.
+    Offered during the handshake; the peer only packs segments together if
+    it understands the offer. 1 disables the mode. Worth raising on
+    loopback, where a datagram can be up to 64 KiB without fragmenting.
+"""
+SEGMENTS_PER_DATAGRAM = 1
+
+"""
+UDP_OFFLOAD:
+    Whether sockets ask their lossy layer for Linux UDP segmentation and
+    receive offload (GSO/GRO), see LossyLayer. Off by default: offload
+    needs UDP checksums, so corrupted datagrams are then dropped by the
+    kernel before bTCP's own checksum ever sees them. Worth turning on for
+    throughput on Linux; the lossy layer falls back to plain sends and
+    receives where the kernel does not support it.
+"""
+UDP_OFFLOAD = False
+
+"""
+MAX_RETRIES:
+    How many times in a row a segment (SYN, FIN, or the oldest unacknowledged
+    data segment) is retransmitted without any progress before the connection
+    attempt, or the connection itself, is aborted.
+"""
+MAX_RETRIES = 50
+
+"""
+FIN_RETRIES:
+    How many times the server retransmits its FIN|ACK, backing off, before
+    it closes without the client's final ACK. A lost FIN|ACK is repaired by
+    the client retransmitting its FIN, but the client closes right after
+    sending its final ACK: if that gets lost, nothing will ever answer. The
+    server's close() lingers for at most 1 + 2 + 4 RTOs this way.
+"""
+FIN_RETRIES = 2
+
+"""
+SACK_BLOCKS:
+    Maximum number of selective acknowledgement blocks (ranges of segments
+    received out of order) this end sends or accepts in the payload of an
+    ACK. Offered during the handshake, so a peer that does not understand
+    the option never sees one. 0 disables SACK.
+"""
+SACK_BLOCKS = 16
+
+"""
+TIMESTAMPS:
+    Whether this end offers receive timestamps during the handshake. Once
+    negotiated, the server stamps every ACK with the time it sent it, which
+    gives the client one-way delay samples of the path towards the server.
+"""
+TIMESTAMPS = True
+
+"""
+EXTENDED_SEQ:
+    Whether this end offers extended sequence numbers during the handshake.
+    Once negotiated, sequence and acknowledgement numbers are 32 bits wide:
+    the SYNs carry the upper 16 bits of the initial sequence numbers in the
+    option, and every later segment carries the upper 16 bits of both
+    numbers ahead of its payload. That keeps a stale duplicate from 65536
+    segments ago from passing for new data on transfers of many GiB.
+"""
+EXTENDED_SEQ = True
+
+"""
+MAX_WINDOW, MAX_WINDOW_SCALE:
+    Largest window (in segments) a socket accepts: half the 16-bit sequence
+    number space, so Selective Repeat can still tell a new segment from an
+    old duplicate. Windows beyond the 255 segments the 8-bit window field
+    can hold are advertised scaled down by a shift count, at most
+    MAX_WINDOW_SCALE, agreed on during the handshake (as in RFC 7323).
+"""
+MAX_WINDOW = 0x8000
+MAX_WINDOW_SCALE = 14
+
+"""
+ACK_EVERY, ACK_DELAY:
+    Delayed acknowledgements: the server acknowledges in-order data once
+    every ACK_EVERY segments, or ACK_DELAY milliseconds after the first
+    segment it has not acknowledged yet, whichever comes first -- but at
+    most once per batch of segments drained from the network. Out-of-order
+    segments, duplicates and segments that fill a gap are acknowledged
+    immediately, so loss recovery is not slowed down. The defaults of
+    server sockets; ACK_EVERY = 1 acknowledges every batch at once.
+"""
+ACK_EVERY = 2
+ACK_DELAY = 20
+
+"""
+RECV_BUFFER, MAX_RECV_BUFFER:
+    Receive buffer autotuning: the server's receive buffer (and with it the
+    window it advertises) starts out at RECV_BUFFER segments. Once per round
+    trip it grows to twice what the application took out of it during the
+    last one, so a sender in slow start is never limited by it, up to the
+    memory ceiling of MAX_RECV_BUFFER segments (the default of server
+    sockets). While the connection is idle, it shrinks back towards
+    RECV_BUFFER.
+"""
+RECV_BUFFER = 128
+MAX_RECV_BUFFER = 4096
+
+"""
+SEND_BUFFER, MAX_SEND_BUFFER:
+    Send buffer autosizing: how many bytes a client socket's send() accepts
+    before the network thread has turned them into segments. Starts out at
+    SEND_BUFFER and grows with the amount of data the connection can have
+    in flight -- its congestion window, limited by both ends' windows --
+    so that a whole next window is always ready to go, up to the ceiling of
+    MAX_SEND_BUFFER bytes (the default of client sockets).
+"""
+SEND_BUFFER = 64 * 1024
+MAX_SEND_BUFFER = 4 * 1024 * 1024
+
+"""
+DUPACK_THRESHOLD, MAX_DUPACK_THRESHOLD:
+    How many segments must be acknowledged beyond a missing one (as
+    duplicate ACKs, or in SACK blocks) before the sender considers it lost
+    and retransmits it without waiting for the retransmission timer. The
+    threshold starts at DUPACK_THRESHOLD and is raised, up to
+    MAX_DUPACK_THRESHOLD (and below the window), whenever the network is
+    seen reordering segments further than that. It decays back towards
+    DUPACK_THRESHOLD by one for every window of segments acknowledged
+    without reordering.
+"""
+DUPACK_THRESHOLD = 3
+MAX_DUPACK_THRESHOLD = 32
+
+"""
+MIN_RTO, MAX_RTO:
+    Bounds for the retransmission timeout in milliseconds. The timeout given
+    to a socket is only its initial RTO; from then on the RTO follows the
+    measured round trip time, and doubles on every expiry, within these
+    bounds.
+"""
+MIN_RTO = 50
+MAX_RTO = 2000
+
+"""
+CONGESTION_CONTROL, INITIAL_CWND:
+    Default congestion control algorithm of client sockets, one of the names
+    in btcp.congestion.ALGORITHMS, and the congestion window (in segments)
+    every algorithm starts with.
+"""
+CONGESTION_CONTROL = "newreno"
+INITIAL_CWND = 10
@@ -7,6 +7,7 @@ However, do read the docstrings to understand what's going on.
 
 import socket
 import select
+import struct
 import sys
 import threading
 import signal
@@ -14,43 +15,105 @@ from _thread import interrupt_main
 
 import logging
 
+from btcp import codec
 from btcp.constants import *
 
 
 logger = logging.getLogger(__name__)
 
 
-def handle_incoming_segments(btcp_socket, event, udp_socket):
+# UDP segmentation / receive offload socket options are not defined in
+# Python, so hardcode the values from /usr/include/linux/udp.h:
+# #define UDP_SEGMENT 103 and #define UDP_GRO 104. The kernel accepts at most
+# UDP_MAX_SEGMENTS (64) segments per GSO send.
+UDP_SEGMENT = 103
+UDP_GRO = 104
+UDP_MAX_SEGMENTS = 64
+_GRO_CMSG_SPACE = socket.CMSG_SPACE(struct.calcsize("i"))
+
+
+def handle_incoming_segments(btcp_socket, event, udp_socket,
+                             batch_limit=RECV_BATCH, gro=False,
+                             datagram_size=SEGMENT_SIZE, wakeup=None):
     """This is the main method of the "network thread".
 
-    Continuously read from the socket and whenever a segment arrives,
-    call the lossy_layer_segment_received method of the associated socket.
+    Continuously read from the socket and whenever segments arrive, drain
+    every datagram already queued on the UDP socket (up to batch_limit) with
+    non-blocking reads, then hand them to the associated socket in one call
+    to its lossy_layer_segments_received method. Sockets that do not provide
+    that method get one lossy_layer_segment_received call per segment instead.
+
+    Datagrams are received straight into a ring of preallocated slots, one
+    per datagram of a batch, and passed on as memoryviews into those slots.
+    The slots are released, and reused for the next batch, as soon as the
+    socket's callback returns: a socket must copy any part of a segment it
+    wants to keep beyond that. This way steady-state receiving does not
+    allocate a new bytes object per datagram.
+
+    Slots are datagram_size bytes. Segments are only as long as their header
+    says, so a datagram carrying several segments back to back (see
+    SEGMENTS_PER_DATAGRAM) is split up by the lengths in their headers, and
+    its segments are passed on individually. If gro is set, UDP_GRO must be
+    enabled on udp_socket: slots are then large enough for a datagram
+    coalesced by the kernel, which is first split back into its original
+    datagrams.
 
     If no segment is received for TIMER_TICK ms, call the lossy_layer_tick
-    method of the associated socket.
+    method of the associated socket. A socket with a timer due sooner can
+    provide a lossy_layer_timeout method, returning the seconds until then
+    (or None): the tick then comes no later than that. Whenever wakeup (the
+    receiving end of a socketpair, see LossyLayer.wakeup) becomes readable,
+    it is emptied and the tick comes right away, even while segments keep
+    arriving.
 
     When flagged, return from the function. This is used by LossyLayer's
     destructor. Note that destruction will *not* attempt to receive or send any
-    more data; after event gets set the method will send one final segment to
-    the transport layer, or give one final tick if no segment is received in
-    TIMER_TICK ms, then return.
+    more data; after event gets set the method will send one final batch of
+    segments to the transport layer, or give one final tick if no segment is
+    received in TIMER_TICK ms, then return.
 
     Students should NOT need to modify any code in this method.
     """
     logger.info("Starting handle_incoming_segments")
+    segments_received = getattr(btcp_socket, "lossy_layer_segments_received",
+                                None)
+    next_timeout = getattr(btcp_socket, "lossy_layer_timeout", None)
+    if gro:
+        ring = [memoryview(bytearray(MAX_DATAGRAM_SIZE))
+                for _ in range(batch_limit)]
+        drain = _drain_gro
+    else:
+        ring = [memoryview(bytearray(datagram_size))
+                for _ in range(batch_limit)]
+        drain = _drain
+    sockets = [udp_socket] if wakeup is None else [udp_socket, wakeup]
     while not event.is_set():
         try:
             # We do not block here, because we might never check the loop condition in that case
-            rlist, wlist, elist = select.select([udp_socket], [], [], TIMER_TICK / 1000)
-            if rlist:
-                segment, address = udp_socket.recvfrom(SEGMENT_SIZE)
-                btcp_socket.lossy_layer_segment_received(segment)
+            timeout = TIMER_TICK / 1000
+            if next_timeout is not None:
+                due = next_timeout()
+                if due is not None:
+                    timeout = max(min(timeout, due), 0)
+            rlist, wlist, elist = select.select(sockets, [], [], timeout)
+            # Emptied before the tick, so a wakeup signalled while it runs
+            # gets a tick of its own.
+            woken = wakeup in rlist
+            if woken:
+                _clear_wakeup(wakeup)
+            if udp_socket in rlist:
+                batch = drain(udp_socket, ring)
                 # We *assume* here that students aren't leaving multiple processes
                 # sending segments from different remote IPs and ports running.
                 # We *could* check the address for validity but then we'd have
                 # to resolve hostnames etc and honestly I don't see a pressing need
                 # for that.
-            else:
+                if segments_received is None:
+                    for segment in batch:
+                        btcp_socket.lossy_layer_segment_received(segment)
+                elif batch:
+                    segments_received(batch)
+            if woken or not rlist:
                 btcp_socket.lossy_layer_tick()
         except Exception as e:
             logger.exception("Exception in the network thread")
@@ -58,6 +121,78 @@ def handle_incoming_segments(btcp_socket, event, udp_socket):
             raise
 
 
+def _clear_wakeup(wakeup):
+    """Read every pending wakeup byte, so select blocks on wakeup again."""
+    try:
+        while wakeup.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _drain(udp_socket, ring):
+    """Receive the datagrams queued on udp_socket, one per ring slot, without
+    blocking. Return a list of views of the segments received.
+
+    MSG_DONTWAIT rather than a non-blocking socket, so send_segment keeps
+    blocking when the kernel send buffer is full. recv_into rather than
+    recvfrom_into: the address is not used, so don't allocate a tuple for it.
+    """
+    batch = []
+    try:
+        for slot in ring:
+            nbytes = udp_socket.recv_into(slot, 0, socket.MSG_DONTWAIT)
+            _append_segments(batch,
+                             slot if nbytes == len(slot) else slot[:nbytes])
+    except BlockingIOError:
+        pass
+    return batch
+
+
+def _drain_gro(udp_socket, ring):
+    """Like _drain, for a socket with UDP_GRO enabled. The kernel reports the
+    size of the original datagrams it coalesced in a control message; split
+    every receive back up at that size.
+    """
+    batch = []
+    try:
+        for slot in ring:
+            nbytes, ancdata, flags, address = udp_socket.recvmsg_into(
+                [slot], _GRO_CMSG_SPACE, socket.MSG_DONTWAIT)
+            if not nbytes:
+                # An empty datagram carries no segment, as in _drain.
+                continue
+            size = nbytes
+            for level, kind, data in ancdata:
+                if level == socket.SOL_UDP and kind == UDP_GRO:
+                    size, = struct.unpack_from("=i", data)
+            for offset in range(0, nbytes, size):
+                _append_segments(batch, slot[offset:min(offset + size, nbytes)])
+    except BlockingIOError:
+        pass
+    return batch
+
+
+def _append_segments(batch, datagram):
+    """Append the segments carried back to back in datagram to batch.
+
+    Segments are delimited by the length in their headers. Whatever cannot
+    be delimited (a truncated header, or a length running past the end of
+    the datagram) is passed on as the final segment, for the socket's length
+    and checksum checks to reject; the rest of such a datagram is lost.
+    """
+    end = len(datagram)
+    offset = 0
+    while end - offset >= HEADER_SIZE:
+        seglen = codec.segment_length(datagram, offset)
+        if offset + seglen >= end:
+            break
+        batch.append(datagram[offset:offset + seglen])
+        offset += seglen
+    if offset < end:
+        batch.append(datagram if offset == 0 else datagram[offset:])
+
+
 class LossyLayer:
     """The lossy layer emulates the network layer in that it provides bTCP with
     an unreliable segment delivery service between a and b.
@@ -69,7 +204,16 @@ class LossyLayer:
 
     Students should NOT need to modify any code in this class.
     """
-    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port):
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 batch_limit=RECV_BATCH, offload=False,
+                 datagram_size=SEGMENT_SIZE):
+        """If offload is set, try to enable Linux UDP segmentation and receive
+        offload (GSO/GRO); see _enable_offload. Falls back to the plain path
+        if the kernel rejects it.
+
+        datagram_size is the largest datagram to be received; raise it above
+        SEGMENT_SIZE to accept several segments per datagram.
+        """
         logger.info("LossyLayer.__init__() was called")
         self._bTCP_socket = btcp_socket
         self._remote_ip = remote_ip
@@ -83,12 +227,21 @@ class LossyLayer:
         # from /usr/include/asm-generic/socket.h:#define SO_NO_CHECK  11.
         self._udp_socket.setsockopt(socket.SOL_SOCKET, 11, 1)
         self._udp_socket.bind((local_ip, local_port))
+        self._offload = offload and self._enable_offload()
+        # Written to by wakeup, to interrupt the network thread's select.
+        self._wakeup, self._wakeup_signal = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._wakeup_signal.setblocking(False)
 
         self._event = threading.Event()
         self._thread = threading.Thread(target=handle_incoming_segments,
                                         args=(self._bTCP_socket,
                                               self._event,
-                                              self._udp_socket),
+                                              self._udp_socket,
+                                              batch_limit,
+                                              self._offload,
+                                              datagram_size,
+                                              self._wakeup),
                                         daemon=True)
         logger.info("Starting network thread")
         self._thread.start()
@@ -101,6 +254,27 @@ class LossyLayer:
                     remote_port)
 
 
+    def _enable_offload(self):
+        """Enable UDP GSO/GRO on the UDP socket, return whether that worked.
+
+        The kernel refuses segmentation offload on sockets that do not
+        generate UDP checksums, so SO_NO_CHECK is turned off again in offload
+        mode. Corrupted datagrams are then dropped by the kernel rather than
+        by the bTCP checksum, which makes no difference to bTCP: a segment
+        with a bad checksum is discarded either way.
+        """
+        try:
+            self._udp_socket.setsockopt(socket.SOL_SOCKET, 11, 0)
+            self._udp_socket.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            logger.warning("UDP offload not supported, using plain sends and "
+                           "receives.", exc_info=True)
+            self._udp_socket.setsockopt(socket.SOL_SOCKET, 11, 1)
+            return False
+        logger.info("UDP offload enabled")
+        return True
+
+
     def __del__(self):
         logger.info("LossyLayer.__del__() called.")
         self.destroy()
@@ -116,28 +290,137 @@ class LossyLayer:
         logger.info("LossyLayer.destroy() called.")
         if self._event is not None and self._thread is not None:
             self._event.set()
+            self.wakeup()
             self._thread.join()
         if self._udp_socket is not None:
             self._udp_socket.close()
+            self._wakeup.close()
+            self._wakeup_signal.close()
         self._event = None
         self._thread = None
         self._udp_socket = None
         logger.info("LossyLayer.destroy() finished.")
 
 
+    def wakeup(self):
+        """Make the network thread call the socket's lossy_layer_tick right
+        away, rather than once no segment has arrived for TIMER_TICK ms,
+        e.g. because the application gave it data to send. Wakeups that
+        come before the network thread got round to the last one share its
+        tick.
+
+        Should be safe to call from either the application thread or the
+        network thread, also once the lossy layer is destroyed.
+        """
+        try:
+            self._wakeup_signal.send(b'\0')
+        except OSError:
+            # Full of wakeups already, or closed by destroy.
+            pass
+
+
     def send_segment(self, segment):
         """Put the segment into the network
 
+        segment is either a single buffer, or a tuple of buffers that make
+        up one segment back to back (e.g. header and payload). The
+        latter are handed to the kernel as-is with scatter/gather sendmsg, so
+        the payload is never copied into a combined buffer.
+
         Should be safe to call from either the application thread or the
         network thread.
         """
         logger.debug("LossyLayer.send_segment() called.")
         logger.debug("Attempting to send segment:")
         logger.debug(segment)
-        bytes_sent = self._udp_socket.sendto(segment,
-                                             (self._remote_ip,
-                                              self._remote_port))
-        if bytes_sent != len(segment):
+        seglen = _segment_length(segment)
+        if isinstance(segment, tuple):
+            bytes_sent = self._udp_socket.sendmsg(segment, (), 0,
+                                                  (self._remote_ip,
+                                                   self._remote_port))
+        else:
+            bytes_sent = self._udp_socket.sendto(segment,
+                                                 (self._remote_ip,
+                                                  self._remote_port))
+        if bytes_sent != seglen:
             logger.critical("The lossy layer was only able to send %i bytes "
                             "of that segment!",
                             bytes_sent)
+
+
+    def send_segments(self, segments, per_datagram=1):
+        """Put a burst of segments into the network
+
+        segments is a list of segments as accepted by send_segment.
+
+        If per_datagram is more than 1, up to that many segments are sent back
+        to back in one datagram with scatter/gather sendmsg. Only do this if
+        the peer agreed to receive such datagrams.
+
+        Otherwise, in offload mode, every run of equally sized segments is
+        handed to the kernel as one sendmsg with UDP_SEGMENT set, which splits
+        it into one datagram per segment again. If the kernel rejects that,
+        offload is switched off and segments are sent one by one from then on.
+
+        Should be safe to call from either the application thread or the
+        network thread.
+        """
+        logger.debug("LossyLayer.send_segments() called with %i segments.",
+                     len(segments))
+        if per_datagram > 1:
+            per_datagram = min(per_datagram,
+                               MAX_DATAGRAM_SIZE // SEGMENT_SIZE)
+            for start in range(0, len(segments), per_datagram):
+                self.send_segment(_flatten(segments[start:start + per_datagram]))
+            return
+        start = 0
+        while start < len(segments):
+            size = _segment_length(segments[start])
+            end = start + 1
+            if self._offload:
+                limit = min(len(segments),
+                            start + UDP_MAX_SEGMENTS,
+                            start + MAX_DATAGRAM_SIZE // size)
+                while end < limit and _segment_length(segments[end]) == size:
+                    end += 1
+            if end - start == 1:
+                self.send_segment(segments[start])
+            else:
+                self._send_gso(segments[start:end], size)
+            start = end
+
+
+    def _send_gso(self, segments, size):
+        try:
+            bytes_sent = self._udp_socket.sendmsg(
+                _flatten(segments), [(socket.SOL_UDP, UDP_SEGMENT,
+                           struct.pack("=H", size))],
+                0, (self._remote_ip, self._remote_port))
+        except OSError:
+            logger.warning("UDP segmentation offload rejected, falling back "
+                           "to sending segments one by one.", exc_info=True)
+            self._offload = False
+            for segment in segments:
+                self.send_segment(segment)
+            return
+        if bytes_sent != size * len(segments):
+            logger.critical("The lossy layer was only able to send %i bytes "
+                            "of that burst of segments!",
+                            bytes_sent)
+
+
+def _flatten(segments):
+    """Return one tuple of all buffers making up segments, for sendmsg."""
+    buffers = []
+    for segment in segments:
+        if isinstance(segment, tuple):
+            buffers.extend(segment)
+        else:
+            buffers.append(segment)
+    return tuple(buffers)
+
+
+def _segment_length(segment):
+    if isinstance(segment, tuple):
+        return sum(map(len, segment))
+    return len(segment)
@@ -0,0 +1,141 @@
+"""Byte ring buffer between the application thread and the network thread.
+
+Each socket moves its data stream across threads through one RingBuffer. The
+client's send() writes into it and its network thread builds segments
+straight out of it; the server's network thread writes delivered data into
+it and recv() reads it out. Data goes in and out in bulk, with one lock
+round trip per call rather than one per segment-sized chunk.
+
+Positions in the stream are kept unwrapped, like sequence numbers: head
+counts the bytes ever taken out, tail the bytes ever written, and the byte
+at position p lives at p % capacity in the buffer. Only one thread ever
+writes and only one ever takes data out, so a position the reader got from
+tail stays valid until the reader itself moves head past it.
+"""
+
+
+import threading
+
+
+class RingBuffer:
+    """A bytearray of capacity bytes holding the stream from head to tail.
+
+    write appends to the stream and read takes everything out of it. peek
+    and consume let the reader look at bytes without copying them and take
+    them out later: memoryviews from peek stay valid until their bytes are
+    consumed, since write only ever fills the free space.
+    """
+
+    def __init__(self, capacity):
+        self._buffer = bytearray(capacity)
+        self._head = 0
+        self._tail = 0
+        # A plain lock guards the bookkeeping: it is several times cheaper
+        # to take than entering a Condition. Only read waits, on a Condition
+        # over the same lock.
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+
+    def __len__(self):
+        return self._tail - self._head
+
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+
+    @property
+    def free(self):
+        return len(self._buffer) - (self._tail - self._head)
+
+
+    @property
+    def head(self):
+        """Position of the oldest byte held: bytes ever taken out."""
+        return self._head
+
+
+    @property
+    def tail(self):
+        """Position after the newest byte held: bytes ever written."""
+        return self._tail
+
+
+    def write(self, data):
+        """Append as much of data as fits, in one copy, and return how many
+        bytes that was. Wakes up a reader waiting in read."""
+        view = memoryview(data)
+        with self._lock:
+            size = min(len(view), self.free)
+            if size:
+                _store(self._buffer, self._tail, view[:size])
+                self._tail += size
+                self._cond.notify()
+        return size
+
+
+    def read(self, timeout=None):
+        """Take everything the buffer holds out of it, as bytes, first
+        waiting up to timeout seconds (None: for as long as it takes) for
+        there to be anything. Return b'' if there still is not."""
+        with self._cond:
+            if not self._cond.wait_for(self.__len__, timeout):
+                return b''
+            data = _load(self._buffer, self._head, len(self))
+            self._head = self._tail
+        return data
+
+
+    def peek(self, position, size):
+        """Return the size bytes from position on, which must be held,
+        without taking them out: a memoryview into the buffer, or a copy if
+        they wrap around its end."""
+        with self._lock:
+            start = position % len(self._buffer)
+            if start + size <= len(self._buffer):
+                return memoryview(self._buffer)[start:start + size]
+            return _load(self._buffer, position, size)
+
+
+    def consume(self, size):
+        """Take the oldest size bytes out, e.g. once peeked at and used."""
+        with self._lock:
+            self._head += min(size, len(self))
+
+
+    def resize(self, capacity):
+        """Move the bytes held into a new buffer of capacity bytes, or of as
+        many as are held, if that is more.
+
+        Memoryviews from peek keep pointing into the old buffer, which keeps
+        their bytes as they were: nothing writes to it any more.
+        """
+        with self._lock:
+            capacity = max(capacity, len(self))
+            if capacity != len(self._buffer):
+                buffer = bytearray(capacity)
+                _store(buffer, self._head,
+                       _load(self._buffer, self._head, len(self)))
+                self._buffer = buffer
+
+
+def _store(buffer, position, data):
+    """Copy data into buffer at stream position, wrapping around its end."""
+    start = position % len(buffer)
+    first = min(len(data), len(buffer) - start)
+    buffer[start:start + first] = data[:first]
+    buffer[:len(data) - first] = data[first:]
+
+
+def _load(buffer, position, size):
+    """Copy size bytes at stream position out of buffer, as bytes."""
+    if not size:
+        return b''
+    view = memoryview(buffer)
+    start = position % len(buffer)
+    first = min(size, len(buffer) - start)
+    if first == size:
+        return bytes(view[start:start + size])
+    return b''.join((view[start:], view[:size - first]))
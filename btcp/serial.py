@@ -0,0 +1,23 @@
+"""Serial number arithmetic (RFC 1982) for bTCP sequence numbers.
+
+Both sockets keep sequence numbers unwrapped: plain Python ints that keep
+counting up from the initial sequence number. Only their lowest 16 bits (or
+32, with extended sequence numbers) go on the wire, so every sequence number
+received has to be unwrapped again, relative to one the socket knows. That
+is unambiguous as long as the two lie less than half the sequence space
+apart, which the window limit guarantees for every segment that is not a
+stale duplicate from a previous wrap of the sequence space.
+"""
+
+
+def diff(a, b, bits=16):
+    """Return a - b for sequence numbers of bits bits: the signed distance
+    from b to a, in [-2**(bits-1), 2**(bits-1)). Either may be unwrapped."""
+    half = 1 << (bits - 1)
+    return ((a - b + half) & ((1 << bits) - 1)) - half
+
+
+def unwrap(value, reference, bits=16):
+    """Return the unwrapped sequence number closest to reference whose
+    lowest bits bits equal value."""
+    return reference + diff(value, reference, bits)
@@ -1,10 +1,10 @@
+from btcp import codec, serial
 from btcp.btcp_socket import BTCPSocket, BTCPStates, BTCPSignals
 from btcp.lossy_layer import LossyLayer
+from btcp.ringbuffer import RingBuffer
 from btcp.constants import *
 
-import queue
 import time
-import struct
 import logging
 
 
@@ -40,28 +40,87 @@ class BTCPServerSocket(BTCPSocket):
     """
 
 
-    def __init__(self, window, timeout):
+    def __init__(self, window, timeout,
+                 ack_every=ACK_EVERY, ack_delay=ACK_DELAY,
+                 max_recv_buffer=MAX_RECV_BUFFER):
         """Constructor for the bTCP server socket. Allocates local resources
         and starts an instance of the Lossy Layer.
 
+        ack_every and ack_delay (in milliseconds) configure delayed
+        acknowledgements, see ACK_EVERY and ACK_DELAY in constants.py.
+        max_recv_buffer (in segments) is the ceiling of receive buffer
+        autotuning, see MAX_RECV_BUFFER. The reorder ring, and with it the
+        largest window we can advertise, holds at least that many segments:
+        the window we advertise is limited by the receive buffer, which
+        _autotune sizes, rather than by the window given.
+
         You can extend this method if you need additional attributes to be
         initialized, but do *not* call accept from here.
         """
         logger.debug("__init__() called.")
-        super().__init__(window, timeout)
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        super().__init__(max(window, max_recv_buffer), timeout)
 
         # The data buffer used by lossy_layer_segment_received to move data
-        # from the network thread into the application thread. Bounded in size.
-        # If data overflows the buffer it will get lost -- that's what window
-        # size negotiation should solve.
-        # For this rudimentary implementation, we simply hope receive manages
-        # to be faster than send.
-        self._recvbuf = queue.Queue(maxsize=1000)
-        logger.info("Socket initialized with recvbuf size 1000")
-
-        # Make sure the example timer exists from the start.
-        self._example_timer = None
+        # from the network thread into the application thread. It has room
+        # for _rcvbuf_size full-size segments. Segments are only released
+        # into it, and acknowledged, while it has room; the rest waits in the
+        # reorder ring below. The window we advertise is the room it has
+        # left, so the client does not send more than it can take.
+        self._rcvbuf_size = min(RECV_BUFFER, max_recv_buffer)
+        self._max_rcvbuf_size = max_recv_buffer
+        self._recvbuf = RingBuffer(self._rcvbuf_size * self._max_payload)
+
+        # Receive buffer autotuning, only used from the network thread: our
+        # estimate of the round trip time (in ms) as seen from the receiving
+        # end, measured from _rtt_start (monotonic_ns), when we first
+        # advertised a window up to _rtt_seq, until the last segment it
+        # allowed arrives; and how far the application had drained the
+        # buffer (its head, in bytes) at _space_time, the start of the
+        # current round trip. _idle_high and _idle_since note when _rcv_high
+        # last moved, i.e. when data last arrived.
+        self._rcv_rtt = None
+        self._rtt_seq = 0
+        self._rtt_start = None
+        self._space_head = None
+        self._space_time = None
+        self._idle_high = None
+        self._idle_since = None
+
+        # Selective Repeat receiver state, only used from the network thread.
+        # Sequence numbers are kept unwrapped here, reduced to _seq_bits bits
+        # on the wire and unwrapped again with the serial module on arrival.
+        # The ring buffers out-of-order segments at index
+        # seqnum % window until the gap before them is filled.
+        self._ring = [None] * self._window
+        self._rcv_next = 0          # next in-order seqnum expected
+        self._seqnum = 0            # our own seqnum after the SYN|ACK
+        self._ack_segment = None    # reused for every ACK we send
+        self._rcv_high = 0          # highest seqnum received, plus one
+        self._rcv_edge = 0          # right edge of the window advertised
+
+        # Delayed acknowledgements: the number of in-order segments received
+        # since our last ACK, the time (monotonic_ns) by which they will be
+        # acknowledged at the latest, and whether we are handling a batch of
+        # segments, which gets one ACK at its end.
+        self._ack_every = ack_every
+        self._ack_delay = ack_delay
+        self._unacked = 0
+        self._ack_deadline = None
+        self._in_batch = False
+
+        # The SYN|ACK or FIN|ACK that is retransmitted until answered.
+        self._control = None
+        self._control_sent = None
+        self._control_deadline = None
+        self._retries = 0
+
+        # Only start the network thread once all state it touches exists.
+        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT,
+                                       CLIENT_IP, CLIENT_PORT,
+                                       offload=UDP_OFFLOAD,
+                                       datagram_size=self._datagram_size())
+        logger.info("Socket initialized with recvbuf size %i, up to %i",
+                    self._rcvbuf_size, self._max_rcvbuf_size)
 
 
     ###########################################################################
@@ -122,81 +181,405 @@ class BTCPServerSocket(BTCPSocket):
         each elif.
         """
         logger.debug("lossy_layer_segment_received called")
-        logger.debug(segment)
-        raise NotImplementedError("Only rudimentary implementation of lossy_layer_segment_received present. Read the comments & code of server_socket.py, then remove the NotImplementedError.")
+
+        if not self.verify_segment(segment):
+            logger.warning("Dropping segment with invalid length or checksum")
+            return
+        unpacked = self._unpack_segment(segment)
+        if unpacked is None:
+            logger.warning("Dropping segment without sequence number "
+                           "extension")
+            return
+        header, payload = unpacked
 
         # match ... case is available since Python 3.10
         # Note, this is *not* the same as a "switch" statement from other
         # languages. There is no "fallthrough" behaviour, so no breaks.
         match self._state:
-            case BTCPStates.CLOSED:
-                self._closed_segment_received(segment)
+            case BTCPStates.ACCEPTING:
+                self._accepting_segment_received(header, payload)
+            case BTCPStates.SYN_RCVD:
+                self._syn_rcvd_segment_received(header, payload)
+            case BTCPStates.ESTABLISHED:
+                self._established_segment_received(header, payload)
             case BTCPStates.CLOSING:
-                self._closing_segment_received(segment)
+                self._closing_segment_received(header, payload)
             case _:
-                self._other_segment_received(segment)
-
-        # If you don't have Python 3.10, the following if ... elif ... else
-        # is an equivalent option.
-        #if self._state == BTCPStates.CLOSED:
-        #    self._closed_segment_received(segment)
-        #elif self._state == BTCPStates.CLOSING:
-        #    self._closing_segment_received(segment)
-        #else:
-        #    logger.info("Segment received in %s state",
-        #                self._state)
-        #    self._other_segment_received(segment)
+                self._other_segment_received(header, payload)
 
         self._expire_timers()
         return
 
 
-    def _closed_segment_received(self, segment):
-        """Helper method handling received segment in CLOSED state
+    def lossy_layer_segments_received(self, segments):
+        """Handle a batch of segments drained from the network, then cover
+        the in-order data among them with a single cumulative ACK -- unless
+        that is less than ack_every segments, which the delayed ACK timer
+        takes care of.
         """
-        logger.debug("_closed_segment_received called")
-        logger.warning("Segment received in CLOSED state.")
-        logger.warning("Normally we wouldn't process this, but the "
-                       "rudimentary implementation never leaves the CLOSED "
-                       "state.")
-        # Get length from header. Change this to a proper segment header unpack
-        # after implementing BTCPSocket.unpack_segment_header in btcp_socket.py
-        datalen, = struct.unpack("!H", segment[6:8])
-        # Slice data from incoming segment.
-        chunk = segment[HEADER_SIZE:HEADER_SIZE + datalen]
-        # Pass data into receive buffer so that the application thread can
-        # retrieve it.
+        self._in_batch = True
         try:
-            self._recvbuf.put_nowait(chunk)
-        except queue.Full:
-            # Data gets dropped if the receive buffer is full. You need to
-            # ensure this doesn't happen by using window sizes and not
-            # acknowledging dropped data.
-            # Initially, while still developing other features,
-            # you can also just set the size limitation on the Queue
-            # much higher, or remove it altogether.
-            logger.critical("Data got dropped!")
-            logger.debug(chunk)
-
-
-    def _closing_segment_received(self, segment):
-        """Helper method handling received segment in CLOSING state
-
-        Currently solely for demonstration purposes.
+            super().lossy_layer_segments_received(segments)
+        finally:
+            self._in_batch = False
+        self._ack_pending()
+
+
+    def _accepting_segment_received(self, header, payload):
+        """Helper method handling received segment in ACCEPTING state: answer
+        a SYN with a SYN|ACK confirming the options we support as well.
         """
-        logger.debug("_closing_segment_received called")
-        logger.info("Segment received in CLOSING state.")
-        logger.info("This needs to be properly implemented. "
-                    "Currently only here for demonstration purposes.")
+        logger.debug("_accepting_segment_received called")
+        seqnum, acknum, syn_set, ack_set, fin_set, window, length, _ = header
+        if not syn_set or ack_set or fin_set:
+            logger.debug("Ignoring non-SYN segment while accepting")
+            return
+        offered = self._negotiate(payload)
+        self._rcv_next = self._rcv_high = self._peer_isn(seqnum, offered) + 1
+        self._seqnum = self._isn + 1
+        self._retries = 0
+        self._control_sent = time.monotonic_ns()
+        self._control_deadline = self._control_sent + self._rto_ns()
+        # The window in a SYN|ACK is never scaled.
+        self._control = self.build_segment(self._isn & 0xFFFF,
+                                           self._rcv_next & 0xFFFF,
+                                           syn_set=True, ack_set=True,
+                                           window=min(self._window, 0xFF),
+                                           payload=self._syn_options(offered))
+        self._state = BTCPStates.SYN_RCVD
+        logger.info("SYN received, sending SYN|ACK")
+        self._lossy_layer.send_segment(self._control)
+
+
+    def _syn_rcvd_segment_received(self, header, payload):
+        """Helper method handling received segment in SYN_RCVD state: the
+        client's ACK of our SYN|ACK completes the handshake. If that ACK got
+        lost, its first data segment (which also acknowledges it) does.
+        """
+        logger.debug("_syn_rcvd_segment_received called")
+        seqnum, acknum, syn_set, ack_set, fin_set, window, length, _ = header
+        if syn_set and not ack_set:
+            logger.debug("Duplicate SYN, sending SYN|ACK again")
+            self._lossy_layer.send_segment(self._control)
+        elif (ack_set and serial.unwrap(acknum, self._seqnum, self._seq_bits)
+                == self._seqnum):
+            if self._retries == 0:
+                self._rtt_sample((time.monotonic_ns() - self._control_sent)
+                                 / 1_000_000)
+            self._control = None
+            self._retries = 0
+            self._ack_segment = self.build_segment(
+                self._seqnum & 0xFFFF, self._rcv_next & 0xFFFF, ack_set=True,
+                window=self._advertised_window(),
+                payload=self._extension(self._seqnum, self._rcv_next)
+                + (codec.TIMESTAMP.pack(0) if self._timestamps else b''))
+            self._space_head = self._recvbuf.head
+            self._idle_high = self._rcv_high
+            self._space_time = self._idle_since = time.monotonic_ns()
+            self._state = BTCPStates.ESTABLISHED
+            logger.info("Connection established")
+            if length or fin_set:
+                self._established_segment_received(header, payload)
+
+
+    def _established_segment_received(self, header, payload):
+        """Helper method handling received segment in ESTABLISHED state:
+        buffer data, and answer an in-order FIN with a FIN|ACK.
+        """
+        logger.debug("_established_segment_received called")
+        seqnum, acknum, syn_set, ack_set, fin_set, window, length, _ = header
+        if fin_set:
+            if (serial.unwrap(seqnum, self._rcv_next, self._seq_bits)
+                    != self._rcv_next):
+                # Not all data has been received yet: the client will
+                # retransmit the FIN after the data it is missing.
+                logger.debug("Out-of-order FIN")
+                self._send_ack()
+                return
+            self._rcv_next += 1
+            self._retries = 0
+            # The FIN|ACK acknowledges everything, so no ACK is pending.
+            self._unacked = 0
+            self._ack_deadline = None
+            self._control_deadline = time.monotonic_ns() + self._rto_ns()
+            self._control = self.build_segment(
+                self._seqnum & 0xFFFF, self._rcv_next & 0xFFFF,
+                ack_set=True, fin_set=True, window=self._advertised_window(),
+                payload=self._extension(self._seqnum, self._rcv_next))
+            self._state = BTCPStates.CLOSING
+            logger.info("FIN received, sending FIN|ACK")
+            self._lossy_layer.send_segment(self._control)
+        elif length:
+            self._data_received(seqnum, payload)
+        else:
+            # Without data or FIN, this is the client probing our zero
+            # window (or a late handshake ACK): tell it the current one.
+            logger.debug("Window probe")
+            self._send_ack()
+
+
+    def _data_received(self, seqnum, payload):
+        """Buffer the data segment seqnum in the reorder ring if it falls in
+        the receive window, release any contiguous run to the application and
+        acknowledge cumulatively. Anything else (e.g. a duplicate of data
+        already delivered) is only acknowledged again.
+
+        Only the ACK of the next in-order segment, when no later ones are
+        waiting, is delayed. Anything out of order, duplicated or filling a
+        gap is acknowledged at once, so the client learns about holes (and
+        their repair) without delay.
+        """
+        seqnum = serial.unwrap(seqnum, self._rcv_next, self._seq_bits)
+        offset = seqnum - self._rcv_next
+        if 0 <= offset < self._window:
+            index = seqnum % self._window
+            if self._ring[index] is not None:
+                self._send_ack(seqnum, duplicate=True)
+                return
+            # Copy the payload out of the incoming segment: the segment
+            # itself is a view into a receive slot the lossy layer reuses
+            # once we return.
+            self._ring[index] = bytes(payload)
+            self._rcv_high = max(self._rcv_high, seqnum + 1)
+            self._deliver()
+            if offset == 0 and self._rcv_high == seqnum + 1:
+                self._unacked += 1
+                if not self._in_batch:
+                    self._ack_pending()
+            else:
+                self._send_ack(seqnum)
+        elif -self._window <= offset < 0:
+            logger.debug("Duplicate of delivered segment %i", seqnum)
+            self._send_ack(seqnum, duplicate=True)
+        else:
+            logger.debug("Segment %i outside the receive window", seqnum)
+            self._send_ack()
 
 
-    def _other_segment_received(self, segment):
+    def _deliver(self):
+        """Release the run of in-order segments at the start of the ring into
+        the receive buffer, for as long as it has room. Return whether
+        anything was released.
+        """
+        delivered = False
+        while True:
+            index = self._rcv_next % self._window
+            chunk = self._ring[index]
+            if chunk is None:
+                return delivered
+            if self._receive_room() < len(chunk):
+                logger.warning("Receive buffer full, holding back data")
+                return delivered
+            self._recvbuf.write(chunk)
+            self._ring[index] = None
+            self._rcv_next += 1
+            delivered = True
+
+
+    def _receive_room(self):
+        """The room left in the receive buffer, in bytes. The buffer itself
+        cannot shrink below the data it holds, so this also counts against
+        _rcvbuf_size."""
+        return min(self._recvbuf.free,
+                   self._rcvbuf_size * self._max_payload - len(self._recvbuf))
+
+
+    def _receive_window(self):
+        """The room left in the receive buffer, in full-size segments: at
+        most our window, and rounded down to what the window field can
+        express."""
+        room = min(self._window, self._receive_room() // self._max_payload)
+        return min(room >> self._window_shift, 0xFF) << self._window_shift
+
+
+    def _advertised_window(self):
+        """Window value for our headers: the receive window, scaled down.
+        Remembers the right edge of the window it advertises, and times how
+        long the client takes to fill a new one, see _autotune.
+
+        Delivering a segment into the receive buffer moves _rcv_next and
+        takes up at most one full-size segment of room, so the right edge
+        only moves when the application takes data out. Up to rounding to
+        the window scale, it never shrinks, and any segment the client sends
+        within it is sure to fit.
+        """
+        window = self._receive_window()
+        edge = self._rcv_next + window
+        if edge > self._rtt_seq and self._rtt_start is None:
+            self._rtt_seq = edge
+            self._rtt_start = time.monotonic_ns()
+        self._rcv_edge = edge
+        return window >> self._window_shift
+
+
+    def _window_opened(self):
+        """Whether recv made room beyond the window we last advertised, of
+        which the client has not been told yet."""
+        return self._rcv_next + self._receive_window() > self._rcv_edge
+
+
+    def _autotune(self, now):
+        """Receive buffer autotuning, like Linux's dynamic right-sizing.
+
+        Estimate the round trip time as the time from advertising a new
+        right edge of our window until the last segment it allowed arrives:
+        a sender limited by our window sends that segment as soon as our
+        ACK reaches it. As in Linux, only the lowest sample counts, since a
+        sender that is not limited by our window only makes this take
+        longer. Until there is one, the buffer keeps its size.
+
+        Once per round trip, grow the buffer to twice what the application
+        took out of it during the last one: enough for a sender doubling
+        its rate every round trip, never more than the application can
+        drain. How fast the buffer drains is capped by its own size, so in
+        a fast transfer it doubles every round trip, up to the ceiling.
+
+        Once no data arrived for two round trips (and TIMER_TICK), the
+        connection is idle, or the application stalled and our window is
+        closed: halve the buffer every such period, down to RECV_BUFFER,
+        so it does not tie up memory for a burst that may never come. Data
+        it holds stays; only the room for more goes. That shrinks the
+        window we advertised, so the client is told right away, before it
+        sends into it again.
+        """
+        if self._rtt_start is not None and self._rcv_high >= self._rtt_seq:
+            rtt = (now - self._rtt_start) / 1_000_000
+            if self._rcv_rtt is None or rtt < self._rcv_rtt:
+                self._rcv_rtt = rtt
+            self._rtt_start = None
+        drained = self._recvbuf.head
+        if self._rcv_high != self._idle_high:
+            self._idle_high = self._rcv_high
+            self._idle_since = now
+        elif (now - self._idle_since
+              >= max(TIMER_TICK, 2 * (self._rcv_rtt or 0)) * 1_000_000):
+            self._idle_since = self._space_time = now
+            self._space_head = drained
+            size = max(self._rcvbuf_size // 2,
+                       min(RECV_BUFFER, self._max_rcvbuf_size))
+            if size < self._rcvbuf_size:
+                logger.debug("Idle, receive buffer shrinks to %i segments",
+                             size)
+                self._resize_receive_buffer(size)
+                if self._rcv_next + self._receive_window() < self._rcv_edge:
+                    self._send_ack()
+        if (self._rcv_rtt is None
+                or now - self._space_time < self._rcv_rtt * 1_000_000):
+            return
+        size = min(2 * (drained - self._space_head) // self._max_payload,
+                   self._max_rcvbuf_size)
+        if size > self._rcvbuf_size:
+            logger.debug("Receive buffer grows to %i segments", size)
+            self._resize_receive_buffer(size)
+        self._space_head = drained
+        self._space_time = now
+
+
+    def _resize_receive_buffer(self, size):
+        """Make room in the receive buffer for size full-size segments. Data
+        it holds stays, even if there is more of it, see _receive_room."""
+        self._rcvbuf_size = size
+        self._recvbuf.resize(size * self._max_payload)
+
+
+    def _ack_pending(self):
+        """Acknowledge the in-order segments received since our last ACK if
+        there are ack_every of them, else start the delayed ACK timer."""
+        if self._unacked >= self._ack_every:
+            self._send_ack()
+        elif self._unacked and self._ack_deadline is None:
+            self._ack_deadline = (time.monotonic_ns()
+                                  + self._ack_delay * 1_000_000)
+
+
+    def _send_ack(self, latest=None, duplicate=False):
+        """Acknowledge everything received in order so far. The same ACK
+        segment is reused, with acknum and window refreshed in place.
+
+        If SACK was negotiated and segments are waiting in the reorder ring,
+        the ACK instead carries SACK blocks describing them, the one holding
+        the segment latest that triggered the ACK first. If latest was a
+        duplicate, a D-SACK block (RFC 2883) reporting it goes first.
+
+        If timestamps were negotiated, every ACK carries the current time,
+        for the client's one-way delay samples, ahead of any SACK blocks
+        (and behind the extension, with extended sequence numbers).
+        """
+        self._unacked = 0
+        self._ack_deadline = None
+        timestamp = time.monotonic_ns() // 1000 & 0xFFFFFFFF
+        stamp = codec.TIMESTAMP.pack(timestamp) if self._timestamps else b''
+        extension = self._extension(self._seqnum, self._rcv_next)
+        if self._sack_blocks:
+            blocks = self._sack_ranges(latest)
+            if duplicate:
+                blocks.insert(0, (latest, latest + 1))
+                del blocks[self._sack_blocks:]
+            if blocks:
+                self._lossy_layer.send_segment(self.build_segment(
+                    self._seqnum & 0xFFFF, self._rcv_next & 0xFFFF,
+                    ack_set=True, window=self._advertised_window(),
+                    payload=extension + stamp
+                    + codec.pack_sack_blocks(blocks)))
+                return
+        self._refresh_extension(self._ack_segment, self._seqnum,
+                                self._rcv_next)
+        if self._timestamps:
+            codec.refresh_timestamp(self._ack_segment, timestamp,
+                                    HEADER_SIZE + len(extension))
+        self.refresh_segment_header(self._ack_segment,
+                                    self._rcv_next & 0xFFFF,
+                                    self._advertised_window())
+        self._lossy_layer.send_segment(self._ack_segment)
+
+
+    def _sack_ranges(self, latest=None):
+        """Return up to _sack_blocks (start, end) ranges of segments in the
+        reorder ring beyond the next in-order one, latest's range first.
+        Only the ring up to the highest segment received is scanned, and
+        nothing at all while no segment arrived out of order."""
+        end = min(self._rcv_next + self._window, self._rcv_high)
+        if end <= self._rcv_next + 1:
+            return []
+        ranges = []
+        start = None
+        for seqnum in range(self._rcv_next + 1, end + 1):
+            present = (seqnum < end
+                       and self._ring[seqnum % self._window] is not None)
+            if present and start is None:
+                start = seqnum
+            elif not present and start is not None:
+                if latest is not None and start <= latest < seqnum:
+                    ranges.insert(0, (start, seqnum))
+                else:
+                    ranges.append((start, seqnum))
+                start = None
+        return ranges[:self._sack_blocks]
+
+
+    def _closing_segment_received(self, header, payload):
+        """Helper method handling received segment in CLOSING state: wait for
+        the client's ACK of our FIN|ACK.
+        """
+        logger.debug("_closing_segment_received called")
+        seqnum, acknum, syn_set, ack_set, fin_set, window, length, _ = header
+        if fin_set:
+            logger.debug("Duplicate FIN, sending FIN|ACK again")
+            self._lossy_layer.send_segment(self._control)
+        elif (ack_set and serial.unwrap(acknum, self._seqnum + 1,
+                                        self._seq_bits) == self._seqnum + 1):
+            self._control = None
+            self._state = BTCPStates.CLOSED
+            logger.info("Connection closed")
+        elif length:
+            self._send_ack()
+
+
+    def _other_segment_received(self, header, payload):
         """Helper method handling received segment in any other state
-
-        Currently solely for demonstration purposes.
         """
         logger.debug("_other_segment_received called")
-        logger.info("Segment received in %s state",
+        logger.info("Ignoring segment received in %s state",
                     self._state)
 
 
@@ -207,51 +590,79 @@ class BTCPServerSocket(BTCPSocket):
         NOTE: Will NOT be called if segments are arriving; do not rely on
         simply counting calls to this method for an accurate timeout. If 10
         segments arrive, each 99 ms apart, this method will NOT be called for
-        over a second!
+        over a second! Except: recv() wakes the network thread to call it
+        right away when it opens a closed window.
 
         The primary use for this method is to be able to do things in the
         "network thread" even while no segments are arriving -- which would
-        otherwise trigger a call to lossy_layer_segment_received. On the server
-        side, you may find you have no actual need for this method. Or maybe
-        you do. See if it suits your implementation.
-
-        You will probably see some code duplication of code that doesn't handle
-        the incoming segment among lossy_layer_segment_received and
-        lossy_layer_tick. That kind of duplicated code would be a good
-        candidate to put in a helper method which can be called from either
-        lossy_layer_segment_received or lossy_layer_tick.
+        otherwise trigger a call to lossy_layer_segment_received. On the
+        server side, that is retransmitting the SYN|ACK or FIN|ACK, releasing
+        data that was held back because the receive buffer was full, and
+        telling the client when recv made room in it again. The client
+        probes a zero window as well, in case that update gets lost.
         """
         logger.debug("lossy_layer_tick called")
-        self._start_example_timer()
         self._expire_timers()
-        raise NotImplementedError("No implementation of lossy_layer_tick present. Read the comments & code of server_socket.py.")
+        if (self._state == BTCPStates.ESTABLISHED
+                and (self._deliver() or self._window_opened())):
+            self._send_ack()
+
+
+    def lossy_layer_timeout(self):
+        """Seconds until the delayed ACK or the SYN|ACK or FIN|ACK
+        retransmission is due, so the lossy layer ticks in time for it; None
+        if neither is pending."""
+        deadlines = [self._ack_deadline]
+        if self._control is not None:
+            deadlines.append(self._control_deadline)
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if not deadlines:
+            return None
+        return (min(deadlines) - time.monotonic_ns()) / 1e9
 
 
-    # The following two functions show you how you could implement a (fairly
-    # inaccurate) but easy-to-use timer.
     # You *do* have to call _expire_timers() from *both* lossy_layer_tick
     # and lossy_layer_segment_received, for reasons explained in
     # lossy_layer_tick.
-    def _start_example_timer(self):
-        if not self._example_timer:
-            logger.debug("Starting example timer.")
-            # Time in *nano*seconds, not milli- or microseconds.
-            # Using a monotonic clock ensures independence of weird stuff
-            # like leap seconds and timezone changes.
-            self._example_timer = time.monotonic_ns()
-        else:
-            logger.debug("Example timer already running.")
-
-
     def _expire_timers(self):
+        """Autotune the receive buffer once per round trip. Send the delayed
+        ACK if its time has come. Retransmit the pending SYN|ACK or FIN|ACK
+        if its timer expired, backing off, and give up on it after
+        MAX_RETRIES, or on the FIN|ACK after FIN_RETRIES.
+        """
+        # Time in *nano*seconds, not milli- or microseconds. Using a
+        # monotonic clock ensures independence of weird stuff like leap
+        # seconds and timezone changes.
         curtime = time.monotonic_ns()
-        if not self._example_timer:
-            logger.debug("Example timer not running.")
-        elif curtime - self._example_timer > self._timeout * 1_000_000:
-            logger.debug("Example timer elapsed.")
-            self._example_timer = None
-        else:
-            logger.debug("Example timer not yet elapsed.")
+        if self._state == BTCPStates.ESTABLISHED:
+            self._autotune(curtime)
+        if self._ack_deadline is not None and curtime >= self._ack_deadline:
+            self._send_ack()
+        if self._control is None:
+            return
+        if curtime < self._control_deadline:
+            return
+        if self._state == BTCPStates.CLOSING and self._retries >= FIN_RETRIES:
+            logger.info("No ACK of our FIN|ACK after %i retransmissions, "
+                        "closing anyway", self._retries)
+            self._control = None
+            self._state = BTCPStates.CLOSED
+            return
+        if self._retries >= MAX_RETRIES:
+            logger.error("No response from the client after %i "
+                         "retransmissions in %s state",
+                         self._retries, self._state.name)
+            self._control = None
+            if self._state == BTCPStates.SYN_RCVD:
+                self._state = BTCPStates.ACCEPTING
+            else:
+                self._state = BTCPStates.CLOSED
+            return
+        logger.info("Retransmitting %s segment", self._state.name)
+        self._retries += 1
+        self._rto_backoff()
+        self._control_deadline = curtime + self._rto_ns()
+        self._lossy_layer.send_segment(self._control)
 
 
     ###########################################################################
@@ -305,7 +716,11 @@ class BTCPServerSocket(BTCPSocket):
         this project.
         """
         logger.debug("accept called")
-        raise NotImplementedError("No implementation of accept present. Read the comments & code of server_socket.py.")
+        if self._state == BTCPStates.CLOSED:
+            self._state = BTCPStates.ACCEPTING
+        # The network thread performs the handshake.
+        while self._state in (BTCPStates.ACCEPTING, BTCPStates.SYN_RCVD):
+            time.sleep(0.001)
 
 
     def recv(self):
@@ -340,41 +755,28 @@ class BTCPServerSocket(BTCPSocket):
         Again, you should feel free to deviate from how this usually works.
         """
         logger.debug("recv called")
-        raise NotImplementedError("Only rudimentary implementation of recv present. Read the comments & code of server_socket.py, then remove the NotImplementedError.")
-
-        # Rudimentary example implementation:
-        # Empty the queue in a loop, reading into a larger bytearray object.
-        # Once empty, return the data as bytes.
-        # If no data is received for 30 seconds, a disconnect is assumed.
-        # At that point recv returns no data and thereby signals disconnect
-        # to the server application.
-        # Proper handling should use the bTCP state machine to check that the
-        # client has disconnected when a timeout happens, and keep blocking
-        # until data has actually been received if it's still possible for
-        # data to appear.
-        data = bytearray()
-        logger.info("Retrieving data from receive queue")
-        try:
-            # Wait until one segment becomes available in the buffer, or
-            # timeout signalling disconnect.
-            logger.info("Blocking get for first chunk of data.")
-            data.extend(self._recvbuf.get(block=True, timeout=30))
-            logger.debug("First chunk of data retrieved.")
-            logger.debug("Looping over rest of queue.")
-            while True:
-                # Empty the rest of the buffer, until queue.Empty exception
-                # exits the loop. If that happens, data contains received
-                # segments so that will *not* signal disconnect.
-                data.extend(self._recvbuf.get_nowait())
-                logger.debug("Additional chunk of data retrieved.")
-        except queue.Empty:
-            logger.debug("Queue emptied or timeout reached")
-            pass # (Not break: the exception itself has exited the loop)
-        logger.debug(data)
-        if not data:
-            logger.info("No data received for 30 seconds.")
-            logger.info("Returning empty bytes to caller, signalling disconnect.")
-        return bytes(data)
+
+        # Block until data is available, then take everything the receive
+        # buffer holds out of it in one go. The FIN is only accepted once all
+        # data before it was released into the buffer, so once the client has
+        # disconnected (before we looked) and the buffer is empty, return no
+        # data to signal disconnect to the application.
+        logger.info("Retrieving data from receive buffer")
+        while True:
+            closed = self._state in (BTCPStates.CLOSING, BTCPStates.CLOSED)
+            data = self._recvbuf.read(timeout=0 if closed
+                                      else TIMER_TICK / 1000)
+            if data:
+                logger.debug("%i bytes of data retrieved.", len(data))
+                if self._rcv_edge <= self._rcv_next:
+                    # Our window was closed: have the network thread tell
+                    # the client about the room made right away.
+                    self._lossy_layer.wakeup()
+                return data
+            if closed:
+                logger.info("Client disconnected, returning empty bytes "
+                            "to caller, signalling disconnect.")
+                return b''
 
 
     def close(self):
@@ -395,6 +797,11 @@ class BTCPServerSocket(BTCPSocket):
             3. set the reference to None.
         """
         logger.debug("close called")
+        # Give the network thread the chance to finish the termination
+        # handshake (bounded by FIN_RETRIES) before tearing it down.
+        while (self._state == BTCPStates.CLOSING
+               and self._lossy_layer is not None):
+            time.sleep(0.001)
         if self._lossy_layer is not None:
             self._lossy_layer.destroy()
         self._lossy_layer = None
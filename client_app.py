@@ -3,7 +3,9 @@
 import argparse
 import time
 import logging
+from btcp import congestion
 from btcp.client_socket import BTCPClientSocket
+from btcp.constants import CONGESTION_CONTROL
 
 """This exposes a constant bytes object called TEST_BYTES_85MIB which, as the
 name suggests, is a little over 85 MiB in size. You can send it, receive it,
@@ -54,8 +56,13 @@ def btcp_file_transfer_client():
                         help="Define bTCP window size",
                         type=int, default=100)
     parser.add_argument("-t", "--timeout",
-                        help="Define bTCP timeout in milliseconds",
+                        help="Define initial bTCP retransmission timeout in milliseconds",
                         type=int, default=100)
+    parser.add_argument("-c", "--congestion",
+                        choices=sorted(congestion.ALGORITHMS),
+                        help="Congestion control algorithm; ledbat yields "
+                             "to other traffic, for background transfers",
+                        default=CONGESTION_CONTROL)
     parser.add_argument("-i", "--input",
                         help="File to send",
                         default="large_input.py")
@@ -71,9 +78,10 @@ def btcp_file_transfer_client():
                         format="%(asctime)s:%(name)s:%(levelname)s:%(message)s")
     logger.info("Set up logger")
 
-    # Create a bTCP client socket with the given window size and timeout value
+    # Create a bTCP client socket with the given window size, timeout value
+    # and congestion control algorithm
     logger.info("Creating client socket")
-    s = BTCPClientSocket(args.window, args.timeout)
+    s = BTCPClientSocket(args.window, args.timeout, args.congestion)
 
     # Connect. By default this doesn't actually do anything: our rudimentary
     # implementation relies on you starting the server before the client,
@@ -53,7 +53,7 @@ def btcp_file_transfer_server():
                         help="Define bTCP window size",
                         type=int, default=100)
     parser.add_argument("-t", "--timeout",
-                        help="Define bTCP timeout in milliseconds",
+                        help="Define initial bTCP retransmission timeout in milliseconds",
                         type=int, default=100)
     parser.add_argument("-o", "--output",
                         help="Where to store the file",
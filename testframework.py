@@ -1,9 +1,13 @@
 import unittest
+import unittest.mock
 import filecmp
 import threading
 import time
 import signal
+import socket
 import sys
+import os
+import struct
 
 """This exposes a constant bytes object called TEST_BYTES_85MIB which, as the
 name suggests, is a little over 85 MiB in size. You can send it, receive it,
@@ -18,6 +22,14 @@ You can also use the file large_input.py as-is for file transfer.
 from large_input import TEST_BYTES_85MIB
 from small_input import TEST_BYTES_72KIB
 
+from btcp import checksum, codec, congestion, serial
+from btcp.btcp_socket import BTCPSignals, BTCPSocket, BTCPStates
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+from btcp.lossy_layer import LossyLayer, handle_incoming_segments
+from btcp.ringbuffer import RingBuffer
+from btcp.constants import *
+
 
 SMALL_INPUTFILE = "small_input.py"
 LARGE_INPUTFILE = "large_input.py"
@@ -322,6 +334,885 @@ class TestbTCPFramework(unittest.TestCase):
         self.runclient_and_assert(infile)
 
 
+class TestbTCPChecksum(unittest.TestCase):
+    """Unit tests for the checksum engine. These need no netem setup."""
+
+    def test_matches_reference(self):
+        """in_cksum is bit-for-bit identical to the 16-bit reference"""
+        samples = [bytes(SEGMENT_SIZE), b'\xff' * SEGMENT_SIZE,
+                   b'\xff\xff' + bytes(SEGMENT_SIZE - 2)]
+        samples += [os.urandom(SEGMENT_SIZE) for _ in range(200)]
+        samples += [os.urandom(2 * n) for n in range(1, 64)]
+        for segment in samples:
+            self.assertEqual(checksum.in_cksum(segment),
+                             checksum.in_cksum_reference(segment))
+
+    def test_verify_roundtrip(self):
+        """a segment carrying its own checksum verifies, a flipped bit not"""
+        payload = os.urandom(PAYLOAD_SIZE)
+        header = BTCPSocket.build_segment_header(1, 2, length=PAYLOAD_SIZE)
+        cksum = BTCPSocket.in_cksum(header + payload)
+        segment = bytearray(BTCPSocket.build_segment_header(
+            1, 2, length=PAYLOAD_SIZE, checksum=cksum) + payload)
+        self.assertTrue(BTCPSocket.verify_checksum(segment))
+        segment[42] ^= 0x10
+        self.assertFalse(BTCPSocket.verify_checksum(segment))
+
+
+    def test_incremental_update(self):
+        """patching the checksum for new header fields matches a full
+        recomputation over the whole segment"""
+        for _ in range(200):
+            payload = os.urandom(PAYLOAD_SIZE)
+            seqnum, acknum, window = struct.unpack("!HHB", os.urandom(5))
+            old_header = BTCPSocket.build_segment_header(
+                seqnum, acknum, window=window, length=PAYLOAD_SIZE)
+            cksum = BTCPSocket.in_cksum(old_header + payload)
+            new_acknum, new_window = struct.unpack("!HB", os.urandom(3))
+            new_header = BTCPSocket.build_segment_header(
+                seqnum, new_acknum, ack_set=True, window=new_window,
+                length=PAYLOAD_SIZE)
+            self.assertEqual(
+                BTCPSocket.update_checksum(cksum, old_header, new_header),
+                BTCPSocket.in_cksum(new_header + payload))
+
+
+class TestbTCPCodec(unittest.TestCase):
+    """Unit tests for the segment header codec. These need no netem setup."""
+
+    def test_header_roundtrip(self):
+        """every flag combination survives packing and unpacking"""
+        for flags in range(8):
+            syn_set, ack_set, fin_set = flags >> 2 & 1, flags >> 1 & 1, flags & 1
+            header = BTCPSocket.build_segment_header(
+                0xBEEF, 0x1234, syn_set, ack_set, fin_set, 0x7F, 42, 0xABCD)
+            self.assertEqual(len(header), HEADER_SIZE)
+            self.assertEqual(BTCPSocket.unpack_segment_header(header),
+                             (0xBEEF, 0x1234, syn_set, ack_set, fin_set,
+                              0x7F, 42, 0xABCD))
+
+    def test_build_segment(self):
+        """build_segment matches header + payload with its checksum, and
+        decodes from a memoryview into a larger buffer"""
+        payload = os.urandom(101)
+        segment = BTCPSocket.build_segment(7, 8, ack_set=True, window=9,
+                                           payload=payload)
+        self.assertEqual(len(segment), HEADER_SIZE + len(payload))
+        self.assertTrue(BTCPSocket.verify_segment(segment))
+        cksum = BTCPSocket.in_cksum(BTCPSocket.build_segment_header(
+            7, 8, ack_set=True, window=9, length=101) + payload)
+        self.assertEqual(bytes(segment), BTCPSocket.build_segment_header(
+            7, 8, ack_set=True, window=9, length=101, checksum=cksum) + payload)
+        parts = BTCPSocket.build_segment_parts(7, 8, ack_set=True, window=9,
+                                               payload=payload)
+        self.assertIs(parts[1], payload)
+        self.assertEqual(b''.join(parts), bytes(segment))
+        view = memoryview(bytes(SEGMENT_SIZE) + segment)[SEGMENT_SIZE:]
+        self.assertEqual(BTCPSocket.unpack_segment_header(view),
+                         (7, 8, 0, 1, 0, 9, 101, cksum))
+
+    def test_length_validation(self):
+        """segments whose length field disagrees with their size are
+        rejected even if the checksum happens to match"""
+        segment = BTCPSocket.build_segment(1, 2, payload=bytes(4))
+        self.assertTrue(BTCPSocket.verify_segment(segment))
+        self.assertFalse(BTCPSocket.verify_segment(segment + bytes(2)))
+        self.assertFalse(BTCPSocket.verify_segment(segment[:-2]))
+        self.assertFalse(BTCPSocket.verify_segment(segment[:HEADER_SIZE - 1]))
+
+    def test_refresh_header(self):
+        """refreshing acknum and window in place keeps the checksum valid"""
+        header, payload = BTCPSocket.build_segment_parts(
+            5, 6, ack_set=True, window=7, payload=os.urandom(333))
+        BTCPSocket.refresh_segment_header(header, 0xFFFE, 0xFF)
+        self.assertTrue(BTCPSocket.verify_segment(header + payload))
+        self.assertEqual(BTCPSocket.unpack_segment_header(header)[:6],
+                         (5, 0xFFFE, 0, 1, 0, 0xFF))
+
+    def test_serial_unwrap(self):
+        """sequence numbers reduced to 16 or 32 bits unwrap to the nearest
+        one across several wraps of the sequence space"""
+        for bits in (16, 32):
+            size = 1 << bits
+            for reference in range(size - 5, 5 * size, size // 3):
+                for distance in (-size // 2, -1, 0, 1, size // 2 - 1):
+                    seqnum = reference + distance
+                    self.assertEqual(serial.unwrap(seqnum % size, reference,
+                                                   bits), seqnum)
+                    self.assertEqual(serial.diff(seqnum % size, reference,
+                                                 bits), distance)
+
+    def test_refresh_timestamp(self):
+        """refreshing an ACK's timestamp in place keeps the checksum valid"""
+        segment = codec.build_segment(5, 6, ack_set=True,
+                                      payload=codec.TIMESTAMP.pack(1))
+        codec.refresh_timestamp(segment, 0x1FFFFFFFF)
+        self.assertTrue(BTCPSocket.verify_segment(segment))
+        self.assertEqual(codec.TIMESTAMP.unpack_from(segment, HEADER_SIZE),
+                         (0xFFFFFFFF,))
+
+
+class TestbTCPLossyLayer(unittest.TestCase):
+    """Loopback tests of the lossy layer's framing. These need no netem."""
+
+    class Sink:
+        def __init__(self):
+            self.batches = []
+            self.received = threading.Event()
+
+        def lossy_layer_segments_received(self, segments):
+            self.batches.append([bytes(segment) for segment in segments])
+            self.received.set()
+
+        def lossy_layer_tick(self):
+            pass
+
+        def wait_for(self, count, timeout=5):
+            """Wait for count segments in all, return whether they came."""
+            deadline = time.monotonic() + timeout
+            while sum(map(len, self.batches)) < count:
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(0.001)
+            return True
+
+    def network_loop(self, datagrams, batch_limit):
+        """Queue datagrams on a UDP socket, then run the network thread's
+        loop on it in this thread until all of them arrived. Return the
+        batches it delivered, as lists of (segment, bytes(segment)) pairs of
+        the view delivered and its contents at the time."""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        event = threading.Event()
+        timer = threading.Timer(5, event.set)
+        batches = []
+
+        class Sink:
+            def lossy_layer_segments_received(self, segments):
+                batches.append([(segment, bytes(segment))
+                                for segment in segments])
+                if sum(map(len, batches)) == len(datagrams):
+                    event.set()
+
+            def lossy_layer_tick(self):
+                pass
+
+        try:
+            receiver.bind((SERVER_IP, 0))
+            for datagram in datagrams:
+                sender.sendto(datagram, receiver.getsockname())
+            timer.start()
+            handle_incoming_segments(Sink(), event, receiver, batch_limit)
+        finally:
+            timer.cancel()
+            sender.close()
+            receiver.close()
+        return batches
+
+    def test_batched_drain(self):
+        """one wakeup drains every queued datagram, up to the batch limit,
+        into a single lossy_layer_segments_received call"""
+        segments = [BTCPSocket.build_segment(seqnum, 0, payload=b'data')
+                    for seqnum in range(6)]
+        batches = self.network_loop(segments, batch_limit=4)
+        self.assertEqual([[data for _, data in batch] for batch in batches],
+                         [segments[:4], segments[4:]])
+
+    def test_receive_slots(self):
+        """every segment of a batch is delivered in a slot of its own, which
+        the next batch reuses once the callback returned"""
+        segments = [BTCPSocket.build_segment(seqnum, 0, payload=os.urandom(8))
+                    for seqnum in range(6)]
+        first, second = self.network_loop(segments, batch_limit=4)
+        self.assertEqual([data for _, data in first + second], segments)
+        slots = [id(segment.obj) for segment, _ in first]
+        self.assertEqual(len(set(slots)), 4)
+        self.assertEqual([id(segment.obj) for segment, _ in second],
+                         slots[:2])
+        # So a socket must copy what it keeps beyond the callback.
+        self.assertEqual(bytes(first[0][0]), segments[4])
+
+    def test_segments_per_datagram(self):
+        """several segments in one datagram arrive as separate segments"""
+        sink = self.Sink()
+        receiver = LossyLayer(sink, SERVER_IP, SERVER_PORT,
+                              CLIENT_IP, CLIENT_PORT,
+                              datagram_size=4 * SEGMENT_SIZE)
+        sender = LossyLayer(self.Sink(), CLIENT_IP, CLIENT_PORT,
+                            SERVER_IP, SERVER_PORT)
+        try:
+            segments = [BTCPSocket.build_segment_parts(
+                            seqnum, 0, payload=os.urandom(seqnum * 500))
+                        for seqnum in range(3)]
+            sender.send_segments(segments, per_datagram=4)
+            self.assertTrue(sink.received.wait(timeout=5))
+            self.assertEqual(sink.batches,
+                             [[b''.join(segment) for segment in segments]])
+        finally:
+            sender.destroy()
+            receiver.destroy()
+
+    def test_offload(self):
+        """segmentation offload sends arrive as separate segments, also
+        after an empty datagram and once the kernel rejects offload"""
+        sink = self.Sink()
+        receiver = LossyLayer(sink, SERVER_IP, SERVER_PORT,
+                              CLIENT_IP, CLIENT_PORT, offload=True)
+        sender = LossyLayer(self.Sink(), CLIENT_IP, CLIENT_PORT,
+                            SERVER_IP, SERVER_PORT, offload=True)
+        try:
+            if not (sender._offload and receiver._offload):
+                self.skipTest("UDP offload not supported")
+            segments = [b''.join(BTCPSocket.build_segment_parts(
+                            seqnum, 0, payload=os.urandom(500)))
+                        for seqnum in range(16)]
+            sender.send_segment(b'')
+            sender.send_segments(segments[:8])
+            self.assertTrue(sink.wait_for(8))
+            self.assertTrue(sender._offload)
+            # The kernel refuses segmentation offload without UDP checksums.
+            sender._udp_socket.setsockopt(socket.SOL_SOCKET, 11, 1)
+            with self.assertLogs("btcp.lossy_layer", "WARNING"):
+                sender.send_segments(segments[8:])
+            self.assertFalse(sender._offload)
+            self.assertTrue(sink.wait_for(16))
+            self.assertEqual(sum(sink.batches, []), segments)
+        finally:
+            sender.destroy()
+            receiver.destroy()
+
+    def test_options_roundtrip(self):
+        """handshake options survive encoding, padding and garbage"""
+        options = {codec.OPT_SEGMENTS_PER_DATAGRAM: b'\x10', 200: b'ab'}
+        payload = codec.pack_options(options)
+        self.assertEqual(codec.unpack_options(payload), options)
+        self.assertEqual(codec.unpack_options(payload + bytes(20)), options)
+        self.assertEqual(codec.unpack_options(payload + b'\x07\xff'), options)
+
+    def test_sack_blocks_roundtrip(self):
+        """SACK blocks wrap to 16 bits and ignore a trailing partial block"""
+        payload = codec.pack_sack_blocks([(5, 9), (0xFFFE, 0x10003)])
+        self.assertEqual(codec.unpack_sack_blocks(payload),
+                         [(5, 9), (0xFFFE, 3)])
+        self.assertEqual(codec.unpack_sack_blocks(payload + b'\x01'),
+                         [(5, 9), (0xFFFE, 3)])
+
+
+class TestbTCPRingBuffer(unittest.TestCase):
+    """Unit tests for the byte ring buffer between the threads."""
+
+    def test_wraparound(self):
+        """writes fill only the free space, also around the end of the
+        buffer; peeks see the stream without taking it out"""
+        ring = RingBuffer(10)
+        self.assertEqual(ring.write(b'abcdefgh'), 8)
+        self.assertEqual(bytes(ring.peek(2, 3)), b'cde')
+        ring.consume(6)
+        self.assertEqual(ring.write(b'123456789'), 8)
+        self.assertEqual((len(ring), ring.free, ring.head, ring.tail),
+                         (10, 0, 6, 16))
+        view = ring.peek(6, 2)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(bytes(ring.peek(7, 4)), b'h123')
+        ring.resize(4)
+        self.assertEqual(ring.capacity, 10, "never below what it holds")
+        ring.resize(16)
+        self.assertEqual(bytes(view), b'gh', "peeks survive a resize")
+        self.assertEqual(ring.read(), b'gh12345678')
+        self.assertEqual((ring.free, ring.head), (16, 16))
+
+    def test_read_waits(self):
+        """read blocks until data is written, or returns b'' on timeout"""
+        ring = RingBuffer(16)
+        self.assertEqual(ring.read(timeout=0.01), b'')
+        timer = threading.Timer(0.01, ring.write, (b'data',))
+        timer.start()
+        self.assertEqual(ring.read(timeout=5), b'data')
+        timer.join()
+
+
+class TestbTCPSockets(unittest.TestCase):
+    """In-process transfers between a server and a client socket over
+    loopback. These need no netem, so they only cover the ideal network."""
+
+    def transfer(self, data, window=WINSIZE, timeout=TIMEOUT):
+        """Send data from a client to a server socket, return what the
+        server received"""
+        server = BTCPServerSocket(window, timeout)
+        received = bytearray()
+
+        def serve():
+            server.accept()
+            while chunk := server.recv():
+                received.extend(chunk)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = BTCPClientSocket(window, timeout)
+        try:
+            client.connect()
+            sent = 0
+            while sent < len(data):
+                sent += client.send(data[sent:])
+            client.shutdown()
+        finally:
+            client.close()
+            thread.join()
+            server.close()
+        return bytes(received)
+
+    def test_transfer_small(self):
+        """data arrives complete and in order"""
+        self.assertEqual(self.transfer(TEST_BYTES_72KIB), TEST_BYTES_72KIB)
+
+    def test_transfer_small_window(self):
+        """the send and reorder rings work when much smaller than the data"""
+        data = TEST_BYTES_72KIB[:20000]
+        self.assertEqual(self.transfer(data, window=3), data)
+
+    def test_transfer_offload(self):
+        """data arrives intact with UDP offload switched on for both ends"""
+        with unittest.mock.patch("btcp.client_socket.UDP_OFFLOAD", True), \
+                unittest.mock.patch("btcp.server_socket.UDP_OFFLOAD", True):
+            self.assertEqual(self.transfer(TEST_BYTES_72KIB, window=1000),
+                             TEST_BYTES_72KIB)
+
+    def test_transfer_large_window(self):
+        """windows beyond what the 8-bit window field holds work scaled"""
+        self.assertEqual(self.transfer(TEST_BYTES_72KIB, window=1000),
+                         TEST_BYTES_72KIB)
+
+    def test_send_latency(self):
+        """small messages go out right away, not on the next idle tick"""
+        server = BTCPServerSocket(WINSIZE, TIMEOUT)
+        thread = threading.Thread(target=server.accept)
+        thread.start()
+        client = BTCPClientSocket(WINSIZE, TIMEOUT)
+        try:
+            client.connect()
+            thread.join()
+            for _ in range(5):
+                time.sleep(0.01)
+                start = time.monotonic()
+                client.send(b'ping')
+                self.assertEqual(server.recv(), b'ping')
+                self.assertLess(time.monotonic() - start,
+                                TIMER_TICK / 2000)
+            client.shutdown()
+        finally:
+            client.close()
+            thread.join()
+            server.close()
+
+    class Recorder:
+        """Stands in for the lossy layer of a socket a test drives directly,
+        and keeps everything the socket sends."""
+        def __init__(self):
+            self.segments = []
+
+        def send_segment(self, segment):
+            # Copied, as the server reuses its ACK segment.
+            if isinstance(segment, tuple):
+                segment = b''.join(segment)
+            self.segments.append(bytes(segment))
+
+        def send_segments(self, segments, segments_per_datagram=1):
+            self.segments.extend(segments)
+
+        def wakeup(self):
+            pass
+
+        def destroy(self):
+            pass
+
+    def driven_server(self, isn, window=WINSIZE, **kwargs):
+        """Return a server socket without network thread, connected to by a
+        client with initial sequence number isn, and a function building
+        segments of that client: segment(seqnum, payload, fin=False). The
+        server's segments are kept in server._lossy_layer.segments."""
+        server = BTCPServerSocket(window, TIMEOUT, **kwargs)
+        server.close()
+        server._lossy_layer = self.Recorder()
+        server._state = BTCPStates.ACCEPTING
+        client = BTCPSocket(WINSIZE, TIMEOUT)
+        client._isn = isn
+        server.lossy_layer_segment_received(client.build_segment(
+            client._isn & 0xFFFF, 0, syn_set=True,
+            payload=client._syn_options()))
+        (seqnum, *_), options = client._unpack_segment(
+            server._lossy_layer.segments.pop())
+        acknum = client._peer_isn(seqnum, client._negotiate(options)) + 1
+
+        def segment(seqnum, payload=b'', fin=False):
+            return client.build_segment(
+                seqnum & 0xFFFF, acknum & 0xFFFF, ack_set=True, fin_set=fin,
+                window=WINSIZE,
+                payload=client._extension(seqnum, acknum) + payload)
+
+        server.lossy_layer_segment_received(segment(isn + 1))
+        self.assertEqual(server._state, BTCPStates.ESTABLISHED)
+        return server, segment
+
+    def driven_client(self, window, segments):
+        """Return a client socket without network thread, connected to a
+        server with the same window, that has sent segments full-size data
+        segments, seqnums 0 and up, and a function building ACK segments of
+        that server: ack(acknum, window=window, blocks=()). The client's
+        segments are kept in client._lossy_layer.segments."""
+        client = BTCPClientSocket(window, TIMEOUT)
+        client.close()
+        client._lossy_layer = self.Recorder()
+        client._state = BTCPStates.ESTABLISHED
+        client._peer_window = window
+        client._congestion.cwnd = segments
+        client.send(bytes(segments * client._max_payload))
+        client.lossy_layer_tick()
+        self.assertEqual(len(client._lossy_layer.segments), segments)
+
+        def ack(acknum, window=window, blocks=()):
+            return BTCPSocket.build_segment(
+                0, acknum, ack_set=True, window=window,
+                payload=codec.pack_sack_blocks(blocks))
+
+        return client, ack
+
+    @staticmethod
+    def seqnum(segment):
+        if isinstance(segment, tuple):
+            segment = b''.join(segment)
+        return BTCPSocket.unpack_segment_header(segment)[0]
+
+    def test_receive_past_wraps(self):
+        """with extended sequence numbers, data arrives intact across several
+        wraps of the 16-bit seqnum field and of the 32-bit sequence space,
+        while stale duplicates from a wrap of the seqnum field ago, which
+        the header alone cannot tell from new data, are refused"""
+        isn = 0xFFFFFFFF - 3 * 0x10000 + 100
+        server, segment = self.driven_server(isn)
+        self.assertEqual(server._seq_bits, 32)
+
+        def send(seqnum, payload):
+            server.lossy_layer_segment_received(segment(seqnum, payload))
+
+        expected = bytearray()
+        received = bytearray()
+        for index in range(1, 4 * 0x10000 + 1000):
+            seqnum = isn + index
+            if index > 0x10000 and index % 1000 == 0:
+                send(seqnum - 0x10000, b'XX')
+            payload = (seqnum & 0xFFFF).to_bytes(2, 'big')
+            send(seqnum, payload)
+            expected += payload
+            received += server._recvbuf.read(timeout=0)
+            server._lossy_layer.segments.clear()
+        self.assertEqual(received, expected)
+
+    def test_fin_after_lost_handshake_ack(self):
+        """a FIN completes the handshake if the client's ACK of the SYN|ACK
+        got lost and no data followed, and a duplicate SYN|ACK is still
+        acknowledged after the FIN was sent"""
+        server = BTCPServerSocket(WINSIZE, TIMEOUT)
+        server.close()
+        server._lossy_layer = self.Recorder()
+        server._state = BTCPStates.ACCEPTING
+        client = BTCPClientSocket(WINSIZE, TIMEOUT)
+        client.close()
+        client._lossy_layer = self.Recorder()
+        to_server = client._lossy_layer.segments
+        to_client = server._lossy_layer.segments
+        thread = threading.Thread(target=client.connect)
+        thread.start()
+        while not to_server:
+            time.sleep(0.001)
+        server.lossy_layer_segment_received(to_server.pop())
+        synack = to_client.pop()
+        client.lossy_layer_segment_received(synack)
+        thread.join()
+        to_server.pop()
+        client._signal = BTCPSignals.SHUTDOWN
+        client.lossy_layer_tick()
+        self.assertEqual(client._state, BTCPStates.FIN_SENT)
+        server.lossy_layer_segment_received(to_server.pop())
+        self.assertEqual(server._state, BTCPStates.CLOSING)
+        finack = to_client.pop()
+        client.lossy_layer_segment_received(synack)
+        self.assertEqual(
+            BTCPSocket.unpack_segment_header(to_server.pop())[2:5],
+            (False, True, False))
+        client.lossy_layer_segment_received(finack)
+        self.assertEqual(client._state, BTCPStates.CLOSED)
+        server.lossy_layer_segment_received(to_server.pop())
+        self.assertEqual(server._state, BTCPStates.CLOSED)
+
+    def test_fin_ack_linger(self):
+        """without the client's final ACK, the server retransmits its
+        FIN|ACK backing off, and closes after FIN_RETRIES of them"""
+        server, segment = self.driven_server(0)
+        sent = server._lossy_layer.segments
+        server.lossy_layer_segment_received(segment(1, fin=True))
+        self.assertEqual((server._state, len(sent)), (BTCPStates.CLOSING, 1))
+        rto = server._rto
+        for _ in range(FIN_RETRIES):
+            server._control_deadline = 0
+            server.lossy_layer_tick()
+        self.assertEqual(sent[1:], sent[:1] * FIN_RETRIES)
+        self.assertEqual(server._rto, min(rto * 2 ** FIN_RETRIES, MAX_RTO))
+        self.assertEqual(server._state, BTCPStates.CLOSING)
+        server._control_deadline = 0
+        server.lossy_layer_tick()
+        self.assertEqual(server._state, BTCPStates.CLOSED)
+
+    def test_delayed_ack(self):
+        """in-order data is acknowledged every ack_every segments, once per
+        batch, or after ack_delay; anything out of order right away"""
+        server, segment = self.driven_server(1000, ack_every=2, ack_delay=20)
+        sent = server._lossy_layer.segments
+        for seqnum in range(1001, 1005):
+            server.lossy_layer_segment_received(segment(seqnum, b'data'))
+        self.assertEqual(len(sent), 2)
+        server.lossy_layer_segments_received(
+            [segment(seqnum, b'data') for seqnum in range(1005, 1015)])
+        self.assertEqual(len(sent), 3)
+        server.lossy_layer_segment_received(segment(1016, b'data'))
+        self.assertEqual(len(sent), 4, "out of order")
+        server.lossy_layer_segment_received(segment(1015, b'data'))
+        self.assertEqual(len(sent), 5, "gap filled")
+        server.lossy_layer_segments_received([segment(1017, b'data')])
+        self.assertEqual(len(sent), 5)
+        self.assertLessEqual(server.lossy_layer_timeout(), 0.02)
+        time.sleep(0.02)
+        server.lossy_layer_tick()
+        self.assertEqual(len(sent), 6)
+        self.assertIsNone(server.lossy_layer_timeout())
+        self.assertEqual(server._rcv_next, 1018)
+
+    def test_sack_ranges(self):
+        """the server reports the runs received out of order, the latest
+        first, scanning its ring only up to the highest segment received"""
+        server, segment = self.driven_server(0, window=1000)
+        server.lossy_layer_segment_received(segment(1, b'data'))
+        self.assertEqual(server._sack_ranges(), [])
+        for seqnum in (4, 5, 9, 7):
+            server.lossy_layer_segment_received(segment(seqnum, b'data'))
+        # Planted beyond the highest segment received: never looked at.
+        server._ring[20] = b'data'
+        self.assertEqual(server._sack_ranges(7), [(7, 8), (4, 6), (9, 10)])
+
+    def test_receive_window(self):
+        """the server advertises the room left in its receive buffer and
+        announces it when recv makes more; the client probes a zero window
+        with backoff"""
+        server, segment = self.driven_server(1000, ack_every=1,
+                                             max_recv_buffer=4)
+        sent = server._lossy_layer.segments
+        data = bytes(server._max_payload)
+
+        def window():
+            return BTCPSocket.unpack_segment_header(sent[-1])[5]
+
+        for seqnum in range(1001, 1005):
+            server.lossy_layer_segment_received(segment(seqnum, data))
+            self.assertEqual(window(), 1004 - seqnum)
+        server.lossy_layer_segment_received(segment(1005))
+        self.assertEqual((len(sent), window()), (5, 0), "probe answered")
+        server.lossy_layer_tick()
+        self.assertEqual(len(sent), 5)
+        self.assertEqual(server.recv(), data * 4)
+        server.lossy_layer_tick()
+        self.assertEqual((len(sent), window()), (6, 4), "window update")
+
+        client = BTCPClientSocket(WINSIZE, MIN_RTO)
+        client.close()
+        client._lossy_layer = self.Recorder()
+        client._state = BTCPStates.ESTABLISHED
+        client._peer_window = 0
+        client.send(b'data')
+        for _ in range(3):
+            client.lossy_layer_tick()
+        self.assertEqual(client._lossy_layer.segments, [])
+        time.sleep(MIN_RTO / 1000)
+        client.lossy_layer_tick()
+        self.assertEqual(len(client._lossy_layer.segments), 1)
+        client.lossy_layer_tick()
+        self.assertEqual(len(client._lossy_layer.segments), 1, "backoff")
+
+    def test_receive_buffer_autotuning(self):
+        """the receive buffer doubles every round trip while the application
+        keeps up with a sender limited by it, up to the ceiling, and halves
+        back to RECV_BUFFER while the connection is idle"""
+        server, segment = self.driven_server(1000, window=4 * RECV_BUFFER,
+                                             ack_every=1,
+                                             max_recv_buffer=4 * RECV_BUFFER)
+        clock = server._space_time
+        sizes = []
+        seqnum = 1001
+        data = bytes(server._max_payload)
+        with unittest.mock.patch.object(time, 'monotonic_ns',
+                                        lambda: clock):
+            for _ in range(6):
+                # A round trip's worth: the window the client was offered.
+                clock += 10_000_000
+                edge = server._rcv_edge
+                while seqnum < edge:
+                    server.lossy_layer_segment_received(segment(seqnum, data))
+                    seqnum += 1
+                server.recv()
+                server.lossy_layer_tick()
+                sizes.append(server._rcvbuf_size)
+            for _ in range(3):
+                clock += 1_000_000_000
+                server.lossy_layer_tick()
+                sizes.append(server._rcvbuf_size)
+        self.assertEqual(sizes[0], RECV_BUFFER)
+        self.assertEqual(sizes[5], 4 * RECV_BUFFER)
+        self.assertEqual(sizes[:6], sorted(sizes[:6]))
+        self.assertEqual(sizes[6:], [2 * RECV_BUFFER, RECV_BUFFER,
+                                     RECV_BUFFER])
+
+    def test_send_buffer(self):
+        """send() accepts exactly the free space of the byte-accounted send
+        buffer, small sends are coalesced into full segments, and the
+        buffer grows to twice the window the connection can use"""
+        client = BTCPClientSocket(WINSIZE, TIMEOUT)
+        client.close()
+        client._lossy_layer = self.Recorder()
+        client._state = BTCPStates.ESTABLISHED
+        client._peer_window = WINSIZE
+        for _ in range(300):
+            self.assertEqual(client.send(b'tiny'), 4)
+        client.lossy_layer_tick()
+        self.assertEqual([len(payload) for _, payload
+                          in client._lossy_layer.segments],
+                         [client._max_payload, 1200 - client._max_payload])
+        # The 1200 bytes in flight stay in the buffer until acknowledged.
+        self.assertEqual(client.send(bytes(SEND_BUFFER + 1)),
+                         SEND_BUFFER - 1200)
+        self.assertEqual(client.send(b'more'), 0)
+        client._congestion.cwnd = WINSIZE
+        client.lossy_layer_tick()
+        self.assertEqual(client._sendbuf.capacity,
+                         2 * WINSIZE * client._max_payload)
+        self.assertEqual(client.send(bytes(SEND_BUFFER)), SEND_BUFFER)
+
+    def test_ack_clocking(self):
+        """every batch of ACKs releases new segments into the room it made
+        in the congestion window at once, without waiting for a tick"""
+        client = BTCPClientSocket(WINSIZE, TIMEOUT)
+        client.close()
+        client._lossy_layer = self.Recorder()
+        client._state = BTCPStates.ESTABLISHED
+        client._peer_window = WINSIZE
+        client._congestion.cwnd = 2
+        client.send(bytes(10 * client._max_payload))
+        client.lossy_layer_tick()
+        sent = client._lossy_layer.segments
+        self.assertEqual(len(sent), 2)
+
+        def ack(acknum):
+            return BTCPSocket.build_segment(0, acknum, ack_set=True,
+                                            window=WINSIZE)
+
+        client.lossy_layer_segments_received([ack(1), ack(2)])
+        self.assertEqual(client._send_base, 2)
+        self.assertEqual(len(sent), 2 + int(client._congestion.window))
+
+    def test_fast_retransmit(self):
+        """three duplicate ACKs fast retransmit the oldest segment and halve
+        cwnd; ACKs that change the window are window updates, not
+        duplicates"""
+        client, ack = self.driven_client(20, 10)
+        sent = client._lossy_layer.segments
+        for window in (10, 15, 20):
+            client.lossy_layer_segment_received(ack(0, window))
+        self.assertEqual((len(sent), client._dupacks), (10, 0))
+        self.assertEqual(client._congestion.cwnd, 10)
+        for _ in range(DUPACK_THRESHOLD):
+            client.lossy_layer_segment_received(ack(0))
+        self.assertEqual([self.seqnum(segment) for segment in sent[10:]], [0])
+        self.assertEqual(client._congestion.cwnd, 5)
+
+    def test_timer_deadlines(self):
+        """the client asks the lossy layer to tick when its retransmission
+        timer is due, not only every TIMER_TICK"""
+        client, ack = self.driven_client(20, 1)
+        client._rto = MIN_RTO
+        client._rto_deadline = time.monotonic_ns() + client._rto_ns()
+        self.assertAlmostEqual(client.lossy_layer_timeout(), MIN_RTO / 1000,
+                               delta=0.01)
+        client.lossy_layer_segment_received(ack(1))
+        self.assertIsNone(client.lossy_layer_timeout())
+
+    def test_partial_ack(self):
+        """without SACK, duplicate ACKs in fast recovery inflate the window,
+        and a partial ACK retransmits the next hole right away and deflates
+        it again"""
+        client, ack = self.driven_client(20, 10)
+        sent = client._lossy_layer.segments
+        client.send(bytes(5 * client._max_payload))
+        for _ in range(DUPACK_THRESHOLD + 3):
+            client.lossy_layer_segment_received(ack(0))
+        self.assertEqual([self.seqnum(segment) for segment in sent[10:]],
+                         [0, 10])
+        client.lossy_layer_segment_received(ack(4))
+        self.assertEqual([self.seqnum(segment) for segment in sent[12:]],
+                         [4, 11])
+        self.assertTrue(client._fast_recovery)
+        client.lossy_layer_segment_received(ack(12))
+        self.assertFalse(client._fast_recovery)
+        self.assertEqual(client._inflation, 0)
+        self.assertEqual([self.seqnum(segment) for segment in sent[14:]],
+                         [12, 13, 14])
+
+    def test_reordering_threshold(self):
+        """a D-SACK for a fast retransmitted segment raises the duplicate
+        ACK threshold, which stays below the window and decays again once a
+        window is acknowledged without reordering"""
+        client, ack = self.driven_client(8, 8)
+        client._sack_blocks = SACK_BLOCKS
+        for _ in range(DUPACK_THRESHOLD):
+            client.lossy_layer_segment_received(ack(0))
+        # The original was only reordered: the server got segment 0 twice.
+        client.lossy_layer_segment_received(ack(8, blocks=[(0, 1)]))
+        self.assertEqual(client._dupthresh, DUPACK_THRESHOLD + 1)
+        client._reordering_detected(MAX_DUPACK_THRESHOLD)
+        self.assertEqual(client._dupthresh, 7)
+        client._congestion.cwnd = 8
+        client.send(bytes(8 * client._max_payload))
+        client.lossy_layer_tick()
+        client.lossy_layer_segment_received(ack(16))
+        self.assertEqual(client._dupthresh, 6)
+
+    def test_sack_holes_retransmitted(self):
+        """one ACK with SACK blocks gets every hole below them retransmitted,
+        and nothing else"""
+        client, ack = self.driven_client(20, 16)
+        client._sack_blocks = SACK_BLOCKS
+        sent = client._lossy_layer.segments
+        client.lossy_layer_segment_received(
+            ack(0, blocks=[(9, 16), (5, 8), (1, 4)]))
+        self.assertEqual([self.seqnum(segment) for segment in sent[16:]],
+                         [0, 4, 8])
+
+    def test_sack_recovery_within_cwnd(self):
+        """after a retransmission timeout, holes the SACK scoreboard finds
+        are retransmitted oldest first and only as far as cwnd allows"""
+        client, ack = self.driven_client(20, 20)
+        client._sack_blocks = SACK_BLOCKS
+        sent = client._lossy_layer.segments
+        client._rto_deadline = 0
+        client.lossy_layer_tick()
+        self.assertEqual([self.seqnum(segment) for segment in sent[20:]], [0])
+        self.assertEqual(client._congestion.cwnd, 1)
+        client.lossy_layer_segment_received(ack(0, blocks=[(15, 20)]))
+        # Segment 0 is still in flight; segments 1 to 14 are lost.
+        self.assertEqual([self.seqnum(segment) for segment in sent[21:]],
+                         list(range(1, int(client._congestion.window))))
+
+    def test_window_scale(self):
+        """both ends agree on shift counts that fit their windows in the
+        window field, and windows beyond MAX_WINDOW are refused"""
+        client = BTCPSocket(1000, TIMEOUT)
+        server = BTCPSocket(100, TIMEOUT)
+        offered = server._negotiate(client._syn_options())
+        client._negotiate(server._syn_options(offered))
+        self.assertEqual((client._window_shift, client._peer_window_shift),
+                         (2, 0))
+        self.assertEqual((server._window_shift, server._peer_window_shift),
+                         (0, 2))
+        self.assertEqual(client._advertised_window(), 250)
+        self.assertEqual(server._advertised_window(), 100)
+        with self.assertRaises(ValueError):
+            BTCPSocket(MAX_WINDOW + 1, TIMEOUT)
+
+    def test_rto_estimation(self):
+        """the RTO starts at the given timeout, follows RTT samples, backs
+        off exponentially and stays within MIN_RTO and MAX_RTO"""
+        sock = BTCPSocket(WINSIZE, 300)
+        self.assertEqual((sock.rto, sock.srtt), (300, None))
+        sock._rtt_sample(40)
+        self.assertEqual((sock.rto, sock.srtt), (120, 40))
+        sock._rtt_sample(40)
+        self.assertEqual((sock.rto, sock.srtt), (100, 40))
+        sock._rto_backoff()
+        self.assertEqual(sock.rto, 200)
+        for _ in range(20):
+            sock._rto_backoff()
+        self.assertEqual(sock.rto, MAX_RTO)
+        for _ in range(50):
+            sock._rtt_sample(0)
+        self.assertEqual(sock.rto, MIN_RTO)
+
+
+class TestbTCPCongestion(unittest.TestCase):
+    """Unit tests of the congestion control algorithms."""
+
+    def test_newreno(self):
+        """slow start doubles, a loss halves, a timeout resets the window"""
+        cc = congestion.create("newreno")
+        cc.on_ack(INITIAL_CWND, 0.01, 0.0, False)
+        self.assertEqual(cc.window, 2 * INITIAL_CWND)
+        cc.on_loss(20, 0.1)
+        self.assertEqual((cc.window, cc.ssthresh), (10, 10))
+        cc.on_ack(5, 0.01, 0.2, True)
+        self.assertEqual(cc.window, 10)
+        cc.on_ack(10, 0.01, 0.3, False)
+        self.assertEqual(cc.window, 11)
+        cc.on_rto(11, 0.4)
+        self.assertEqual(cc.window, 1)
+
+    def test_cubic(self):
+        """after a loss, the window grows back to where the loss happened
+        in K seconds, regardless of the round trip time"""
+        cc = congestion.create("cubic")
+        cc.cwnd = 100
+        cc.on_loss(100, 0.0)
+        self.assertEqual(cc.window, 70)
+        k = (30 / cc.C) ** (1 / 3)
+        now = 0.0
+        while now < k:
+            now += 0.001
+            cc.on_ack(1, 0.0, now, False)
+        self.assertAlmostEqual(cc.cwnd, 100, delta=1)
+        with self.assertRaises(ValueError):
+            congestion.create("vegas")
+
+    def test_bbr(self):
+        """on a 1000 segments/s link with 10 ms round trip time, the model
+        converges to the link and keeps twice its bandwidth-delay product in
+        flight, paced at about the link rate; losses leave it alone"""
+        cc = congestion.create("bbr")
+        now = 0.0
+        while now < 1.0:
+            now += 0.001
+            cc.on_rtt(0.01, now)
+            cc.on_ack(1, 0.01, now, False)
+        self.assertEqual(cc.state, "PROBE_BW")
+        self.assertAlmostEqual(cc.btl_bw, 1000, delta=50)
+        self.assertAlmostEqual(cc.cwnd, 20, delta=2)
+        self.assertAlmostEqual(cc.pacing_rate(), 1000, delta=300)
+        cc.on_loss(20, now)
+        self.assertAlmostEqual(cc.cwnd, 20, delta=2)
+
+    def test_ledbat(self):
+        """the window grows while the queuing delay is below target, and
+        shrinks once it exceeds it; round trip times are only used until
+        one-way delays arrive"""
+        cc = congestion.create("ledbat")
+        cc.on_rtt(0.5, 0.0)
+        cc.on_delay(-3.0, 0.0)
+        self.assertEqual(cc.queuing_delay, 0)
+        for _ in range(10):
+            cc.on_ack(1, 0.01, 0.1, False)
+        self.assertAlmostEqual(cc.cwnd, 11, delta=0.1)
+        for _ in range(cc.CURRENT_FILTER):
+            cc.on_delay(-3.0 + 2 * cc.TARGET, 0.2)
+        for _ in range(11):
+            cc.on_ack(1, 0.01, 0.3, False)
+        self.assertAlmostEqual(cc.cwnd, 10, delta=0.1)
+        cc.on_loss(10, 0.4)
+        self.assertAlmostEqual(cc.cwnd, 5, delta=0.1)
+
+
 #    def test_command(self):
 #        #command=['dir','.']
 #        out = run_command_with_output("dir .")